@@ -0,0 +1,43 @@
+// Draws the uint8 frames of covid_raster.RasterGrid, one pixel per cell scaled up to the canvas
+var RasterModule = function(grid_width, grid_height, canvas_width, canvas_height, palette) {
+	var canvas = $(`<canvas width="${canvas_width}" height="${canvas_height}" class="world-grid"/>`)[0];
+	var parent = $('<div style="height:' + canvas_height + 'px;" class="world-grid-parent"></div>')[0];
+	$("#elements").append(parent);
+	parent.append(canvas);
+	var context = canvas.getContext("2d");
+	context.imageSmoothingEnabled = false;
+
+	// The frame is drawn at grid size off screen, then stretched onto the visible canvas
+	var frame = document.createElement("canvas");
+	frame.width = grid_width;
+	frame.height = grid_height;
+	var frameContext = frame.getContext("2d");
+	var image = frameContext.createImageData(grid_width, grid_height);
+
+	// RGBA of every raster code
+	var colours = palette.map(function(name) {
+		frameContext.fillStyle = name;
+		frameContext.fillRect(0, 0, 1, 1);
+		return frameContext.getImageData(0, 0, 1, 1).data;
+	});
+
+	this.render = function(data) {
+		// null means the server skipped this frame, the last one stays on screen
+		if (data === null) return;
+		var codes = atob(data.data);
+		var pixels = image.data;
+		for (var i = 0; i < codes.length; i++) {
+			var colour = colours[codes.charCodeAt(i)];
+			pixels[4 * i] = colour[0];
+			pixels[4 * i + 1] = colour[1];
+			pixels[4 * i + 2] = colour[2];
+			pixels[4 * i + 3] = 255;
+		}
+		frameContext.putImageData(image, 0, 0);
+		context.drawImage(frame, 0, 0, canvas_width, canvas_height);
+	};
+
+	this.reset = function() {
+		context.clearRect(0, 0, canvas_width, canvas_height);
+	};
+};
@@ -0,0 +1,140 @@
+import argparse
+import contextlib
+import io
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from mesa.visualization.UserParam import UserSettableParameter
+
+from covid_model import CovidModel, model_params
+from covid_population import SyntheticPopulation, population_params, population_rng
+
+compartments = ['Susceptible', 'Infected', 'Recovered & Immune', 'Isolated', 'Dead']
+
+
+def default_params():
+    # Plain values of model_params, without the UserSettableParameter widgets
+    return {name: value.value if isinstance(value, UserSettableParameter) else value
+            for name, value in model_params.items()}
+
+
+def expand_grid(param_grid):
+    # {'a': [1, 2], 'b': [3]} -> [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}]
+    names = list(param_grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(param_grid[n] for n in names))]
+
+
+def population_path(path, params):
+    # Cache file of the population sampled with params, e.g. pop.npz -> pop_no_agents=2000.npz
+    root, ext = os.path.splitext(path)
+    return root + ''.join(f'_{name}={value}' for name, value in params.items()) + ext
+
+
+def run_model(params, seed, max_steps=None):
+    # One headless run, returns the per-step compartment counts as an array
+    with contextlib.redirect_stdout(io.StringIO()):
+        with CovidModel(**dict(params, seed=seed, results_path=None)) as model:
+            while model.running and (max_steps is None or model.schedule.steps < max_steps):
+                model.step()
+    df = model.datacollector.get_model_vars_dataframe()
+    return df[compartments].to_numpy()
+
+
+def run_batch(param_grid, replicates=10, fixed_params=None, max_steps=None,
+              max_workers=None, seed=None, output_path=None):
+    """Run every combination of param_grid replicates times in parallel.
+
+    Each run gets its own seed spawned from seed, so a batch is reproducible
+    and runs are independent. Finished runs are appended to output_path as
+    they come in and the combined per-step series are returned as one
+    DataFrame with run, replicate, step and the swept parameters as columns.
+    """
+    base_params = dict(default_params(), **(fixed_params or {}))
+    combinations = expand_grid(param_grid)
+    combination_params = [dict(base_params, **combination) for combination in combinations]
+    # Runs given a population path share it, sampled here once so workers never race to write it.
+    # Sweeps over the parameters a population is sampled from get one file per combination of them.
+    population = base_params.get('population')
+    if isinstance(population, str):
+        swept = [name for name in param_grid if name in population_params]
+        for params in combination_params:
+            params['population'] = population_path(population, {name: params[name] for name in swept})
+            if not os.path.exists(params['population']):
+                SyntheticPopulation.cached(params['population'], population_rng(seed),
+                                           **{name: params[name] for name in population_params})
+    seeds = np.random.SeedSequence(seed).spawn(len(combinations) * replicates)
+    runs = [(run_id, index, replicate, int(seeds[run_id].generate_state(1)[0]))
+            for run_id, (index, replicate) in
+            enumerate(itertools.product(range(len(combinations)), range(replicates)))]
+
+    results = []
+    header = True
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(run_model, combination_params[index], run_seed, max_steps):
+                   (run_id, combinations[index], replicate, run_seed)
+                   for run_id, index, replicate, run_seed in runs}
+        for future in as_completed(futures):
+            run_id, combination, replicate, run_seed = futures[future]
+            df = pd.DataFrame(future.result(), columns=compartments)
+            df.insert(0, 'step', np.arange(len(df)))
+            for name, value in reversed(list(combination.items())):
+                df.insert(0, name, value)
+            df.insert(0, 'seed', run_seed)
+            df.insert(0, 'replicate', replicate)
+            df.insert(0, 'run', run_id)
+            if output_path is not None:
+                df.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+                header = False
+            results.append(df)
+    return pd.concat(results, ignore_index=True).sort_values(['run', 'step'], ignore_index=True)
+
+
+def aggregate(results, param_names, quantiles=(0.05, 0.5, 0.95)):
+    # Mean and quantile curves over replicates for every parameter combination
+    groups = results.groupby(list(param_names) + ['step'])[compartments]
+    summary = {'mean': groups.mean()}
+    for q in quantiles:
+        summary[f'q{q:g}'] = groups.quantile(q)
+    return pd.concat(summary, axis=1)
+
+
+def parse_sweep(items):
+    # ['mortality_rate=0.01,0.02'] -> {'mortality_rate': [0.01, 0.02]}
+    param_grid = {}
+    for item in items:
+        name, values = item.split('=', 1)
+        param_grid[name] = [parse_value(v) for v in values.split(',')]
+    return param_grid
+
+
+def parse_value(text):
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run CovidModel over a parameter grid in parallel')
+    parser.add_argument('--sweep', nargs='*', default=[], help="e.g. mortality_rate=0.01,0.02 household_size=2,3")
+    parser.add_argument('--replicates', type=int, default=10)
+    parser.add_argument('--steps', type=int, default=None, help='stop runs early after this many steps')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--engine', default='numpy', choices=['mesa', 'numpy'])
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--population', default=None,
+                        help='.npz file every run starts from, sampled and saved there if it does not exist')
+    parser.add_argument('--output', default='batch_results.csv')
+    parser.add_argument('--summary', default='batch_summary.csv')
+    args = parser.parse_args()
+
+    param_grid = parse_sweep(args.sweep)
+    results = run_batch(param_grid, args.replicates, {'engine': args.engine, 'population': args.population}, args.steps,
+                        args.workers, args.seed, args.output)
+    aggregate(results, param_grid).to_csv(args.summary)
+    print(f"{results['run'].nunique()} runs written to {args.output}, summary in {args.summary}")
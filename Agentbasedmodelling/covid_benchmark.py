@@ -0,0 +1,113 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from covid_batch import default_params
+from covid_model import CovidModel
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def timed_run(params, steps):
+    # Build and step one model, returns it with its construction time and per-step times
+    start = time.perf_counter()
+    model = CovidModel(**params)
+    construction = time.perf_counter() - start
+    step_times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        model.step()
+        step_times.append(time.perf_counter() - start)
+    model.close()
+    return model, construction, step_times
+
+
+def run_case(case):
+    # One benchmark case, run in its own process so peak memory is per case. Construction, step times
+    # and memory come from an unprofiled model; the phase split comes from a second, profiled run of
+    # the same seed, since the profiler's timers add to the step time (about doubling it on Mesa).
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    params = dict(default_params(), no_agents=case['no_agents'], width=case['size'], height=case['size'],
+                  lockdown_status=case['lockdown_status'], engine=case['engine'], movement=case['movement'],
+                  seed=case['seed'])
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        params['results_path'] = os.path.join(tmp, 'simulation_results.csv')
+        model, construction, step_times = timed_run(params, case['steps'])
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        profiled, _, profiled_step_times = timed_run(dict(params, profile=True), case['steps'])
+
+    profile = profiled.profiler.get_model_vars_dataframe()
+    return dict(case,
+                construction_s=construction,
+                setup_households_s=model.setup_households_seconds,
+                step_mean_s=float(np.mean(step_times)),
+                step_median_s=float(np.median(step_times)),
+                profiled_step_mean_s=float(np.mean(profiled_step_times)),
+                profiled_phase_per_step_s={name[:-len('_time')]: float(profile[name].mean()) for name in profile
+                                           if name.endswith('_time') and name != 'step_time'},
+                moved_per_step=float(profile['moved'].mean()) if 'moved' in profile else 0.0,
+                bernoulli_draws_per_step=float(profile['bernoulli_draws'].mean()),
+                peak_rss_mb=rss_after / 1024,
+                model_rss_mb=(rss_after - rss_before) / 1024,
+                agent_bytes=model.vector_engine.nbytes_per_agent() if model.vector_engine is not None else None,
+                infected_final=model.infected,
+                dead_final=model.dead)
+
+
+def run_benchmarks(no_agents, sizes, lockdowns, engines, steps, seed=0, movements=('sequential',)):
+    cases = [dict(no_agents=n, size=size, lockdown_status=lockdown, engine=engine, movement=movement,
+                  steps=steps, seed=seed)
+             for engine, movement, n, size, lockdown in itertools.product(engines, movements, no_agents, sizes,
+                                                                          lockdowns)
+             if movement != 'well_mixed' or engine == 'numpy']
+    environment = dict(revision=git_revision(), python=platform.python_version(), numpy=np.__version__,
+                       machine=platform.machine(), timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    context = multiprocessing.get_context('spawn')
+    for case in cases:
+        with context.Pool(1) as pool:
+            yield dict(environment, **pool.apply(run_case, (case,)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time CovidModel construction, per-phase step cost and memory')
+    parser.add_argument('--agents', type=int, nargs='+', default=[1000, 10000, 41000])
+    parser.add_argument('--size', type=int, nargs='+', default=[141], help='grid width and height')
+    parser.add_argument('--lockdown', nargs='+', default=['Complete Lockdown'],
+                        choices=['No Lockdown', 'Partial Lockdown', 'Complete Lockdown'])
+    parser.add_argument('--engine', nargs='+', default=['mesa', 'numpy'], choices=['mesa', 'numpy'])
+    parser.add_argument('--movement', nargs='+', default=['sequential'], choices=['sequential', 'batch', 'well_mixed'],
+                        help='well_mixed cases only run with the numpy engine')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.jsonl', help='one JSON object per case is appended')
+    args = parser.parse_args()
+
+    with open(args.output, 'a') as f:
+        for result in run_benchmarks(args.agents, args.size, args.lockdown, args.engine, args.steps, args.seed,
+                                     args.movement):
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+            phase_summary = ' '.join(f'{phase}={seconds * 1000:.2f}ms'
+                                     for phase, seconds in result['profiled_phase_per_step_s'].items())
+            print(f"{result['engine']:5} {result['movement']:10} agents={result['no_agents']:<7} grid={result['size']}x{result['size']} "
+                  f"{result['lockdown_status']}: init {result['construction_s']:.2f}s, "
+                  f"step {result['step_mean_s'] * 1000:.1f}ms, profiled {result['profiled_step_mean_s'] * 1000:.1f}ms "
+                  f"({phase_summary}), "
+                  f"peak {result['peak_rss_mb']:.0f}MB")
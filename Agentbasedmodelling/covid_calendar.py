@@ -0,0 +1,45 @@
+import numpy as np
+
+
+class CalendarQueue:
+    """Agents bucketed by the tick an event is due for them.
+
+    schedule files agent indices under their due tick and pop hands back the
+    agents due at one tick, so a phase only touches agents whose state
+    changes. Entries are never removed early: an agent rescheduled or
+    cancelled in between is still returned, and the caller checks it against
+    its current due tick.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def __len__(self):
+        return sum(len(agents) for bucket in self.buckets.values() for agents in bucket)
+
+    def schedule(self, agents, ticks):
+        # agents and ticks are matching arrays, negative ticks mean no event
+        agents = np.asarray(agents)
+        ticks = np.asarray(ticks)
+        due = ticks >= 0
+        agents, ticks = agents[due], ticks[due]
+        order = np.argsort(ticks, kind='stable')
+        ticks, agents = ticks[order], agents[order]
+        days, starts = np.unique(ticks, return_index=True)
+        for day, group in zip(days.tolist(), np.split(agents, starts[1:])):
+            self.buckets.setdefault(day, []).append(group)
+
+    def pop(self, tick):
+        bucket = self.buckets.pop(tick, None)
+        if bucket is None:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(bucket)
+
+    def remap(self, new_index):
+        # Agents were renumbered, new_index[old] is the new index or -1 for agents that are gone
+        for day, bucket in self.buckets.items():
+            agents = new_index[np.concatenate(bucket)]
+            self.buckets[day] = [agents[agents >= 0]]
+
+    def clear(self):
+        self.buckets.clear()
@@ -0,0 +1,31 @@
+import json
+import os
+
+import numpy as np
+
+# Bumped whenever the layout of a checkpoint changes
+checkpoint_version = 1
+
+
+def write_checkpoint(path, arrays, meta, compress=False):
+    """Write named arrays plus a JSON-serializable meta dict as one .npz file.
+
+    The file is written next to path first and then renamed, so a worker
+    that dies while snapshotting leaves the previous checkpoint intact.
+    """
+    meta = dict(meta, checkpoint_version=checkpoint_version)
+    arrays = dict(arrays, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        (np.savez_compressed if compress else np.savez)(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path):
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files if name != 'meta'}
+        meta = json.loads(data['meta'].tobytes().decode())
+    if meta.get('checkpoint_version') != checkpoint_version:
+        raise ValueError(f"{path} is a version {meta.get('checkpoint_version')} checkpoint, "
+                         f"expected version {checkpoint_version}")
+    return arrays, meta
@@ -0,0 +1,321 @@
+from time import perf_counter
+
+import numpy as np
+
+from covid_calendar import CalendarQueue
+from covid_households import HouseholdTable
+
+# Status codes used by the vectorized engine, in the same order as AgentStatus
+SUSCEPTIBLE, DEAD, INFECTED, RECOVERED, ISOLATED = range(5)
+
+# Fixed-width dtype of every agent column, x and y widen to int32 on grids over 32767 cells wide
+column_dtypes = {
+    'status': np.uint8,
+    'health_worker': np.bool_,
+    'recovery_countdown': np.int16,
+    'immunity_countdown': np.int16,
+    'infection_day': np.int32,
+    'recovery_due': np.int32,
+    'immunity_due': np.int32,
+    'death_due': np.int32,
+    'temperature': np.float32,
+    'blood_oxygen_level': np.uint8,
+    'x': np.int16,
+    'y': np.int16,
+}
+
+
+# First and last day of their infection on which agents are contagious
+contagious_days = (2, 10)
+
+
+def contagious_on(days):
+    # Whether an infection days old is contagious, days may be a number or an array
+    return (days >= contagious_days[0]) & (days <= contagious_days[1])
+
+
+def position_dtype(width, height):
+    return np.int16 if max(width, height) <= np.iinfo(np.int16).max else np.int32
+
+
+class VectorizedEngine:
+    """Struct-of-arrays version of the Agent rules in covid_model.py.
+
+    Every agent attribute is a NumPy column and each of the Agent.step
+    transitions is applied to all agents at once. Agents are updated from
+    the state at the start of each phase rather than one after another, so
+    runs match the Mesa path statistically, not draw for draw.
+
+    Instead of the Agent countdowns, recovery, immunity loss and death are
+    kept as the tick they are due (-1 for none) and filed in CalendarQueues,
+    so those phases only touch the agents that change that tick. The death
+    tick is drawn once on infection from the geometric distribution the
+    per-tick mortality roll gives.
+    """
+
+    def __init__(self, model, policy, rng=None):
+        self.model = model
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.width = model.grid.width
+        self.height = model.grid.height
+        self.contacts = model.contacts
+        # Compiled PolicyTimeline, movement probability and infection rate are looked up by tick
+        self.policy = policy
+        # Without positions, exposure is the chance of a contagious agent next to a random cell
+        self.well_mixed = model.movement == 'well_mixed'
+
+        self.bernoulli_draws = 0
+        self.dtypes = dict(column_dtypes, x=position_dtype(self.width, self.height),
+                           y=position_dtype(self.width, self.height))
+        # The starting columns come from the model's SyntheticPopulation
+        population = model.population
+        n = len(population)
+        self.status = population.status.astype(self.dtypes['status'])
+        self.health_worker = population.health_worker.astype(self.dtypes['health_worker'])
+        self.infection_day = np.zeros(n, dtype=self.dtypes['infection_day'])
+        self.recovery_due = np.full(n, -1, dtype=self.dtypes['recovery_due'])
+        self.immunity_due = np.full(n, -1, dtype=self.dtypes['immunity_due'])
+        self.death_due = np.full(n, -1, dtype=self.dtypes['death_due'])
+        self.recoveries = CalendarQueue()
+        self.immunity_losses = CalendarQueue()
+        self.deaths = CalendarQueue()
+        self.temperature = population.temperature.astype(self.dtypes['temperature'])
+        self.blood_oxygen_level = population.blood_oxygen_level.astype(self.dtypes['blood_oxygen_level'])
+        self.x = population.x.astype(self.dtypes['x'])
+        self.y = population.y.astype(self.dtypes['y'])
+
+        # Running number of agents per status, kept by set_status
+        self.status_counts = np.bincount(self.status, minlength=5)
+
+        # The first tick is time 0, its recovery phase sees the initial countdowns
+        infected = np.flatnonzero(self.status == INFECTED)
+        self.schedule_recovery(infected, population.recovery_countdown[infected], 0)
+        self.schedule_death(infected, 0)
+
+    def __len__(self):
+        return len(self.status)
+
+    def set_households(self, households):
+        # households is the HouseholdTable built in CovidModel.setup_households
+        self.households = households
+        self.household = households.household_of
+
+    # Columns that make up the population in a checkpoint, countdowns are stored like the Mesa path's
+    state_columns = ['status', 'health_worker', 'recovery_countdown', 'immunity_countdown', 'infection_day',
+                     'temperature', 'blood_oxygen_level', 'x', 'y']
+    # Columns kept per agent
+    agent_columns = ['status', 'health_worker', 'infection_day', 'recovery_due', 'immunity_due', 'death_due',
+                     'temperature', 'blood_oxygen_level', 'x', 'y']
+
+    def get_state(self, time):
+        # time is the next tick, the countdowns are the values its phases would see
+        state = {name: getattr(self, name) for name in self.state_columns if name in self.agent_columns}
+        state['recovery_countdown'] = np.where(self.recovery_due >= time, self.recovery_due - time + 1, 0)
+        state['immunity_countdown'] = np.where(self.immunity_due >= time, self.immunity_due - time + 1, 0)
+        state['death_due'] = self.death_due
+        return state
+
+    def set_state(self, arrays, time):
+        for name in self.state_columns:
+            if name in self.agent_columns:
+                setattr(self, name, arrays[name].astype(self.dtypes[name]))
+        self.status_counts = np.bincount(self.status, minlength=5)
+
+        alive = np.flatnonzero(self.status != DEAD)
+        self.recovery_due[:] = -1
+        self.immunity_due[:] = -1
+        self.recoveries.clear()
+        self.immunity_losses.clear()
+        self.schedule_recovery(alive, arrays['recovery_countdown'][alive], time)
+        self.schedule_immunity_loss(alive, arrays['immunity_countdown'][alive], time)
+        self.deaths.clear()
+        if 'death_due' in arrays:
+            self.death_due = arrays['death_due'].astype(self.dtypes['death_due'])
+            self.deaths.schedule(np.arange(len(self)), self.death_due)
+        else:
+            # Mortality is memoryless, so death ticks missing from a checkpoint can be drawn again
+            self.death_due[:] = -1
+            self.schedule_death(np.flatnonzero(self.status == INFECTED), time)
+
+    def nbytes_per_agent(self):
+        # Bytes of agent columns per agent, households included
+        columns = [getattr(self, name) for name in self.agent_columns] + [self.household]
+        return sum(column.itemsize for column in columns)
+
+    def bernoulli(self, p):
+        # One draw per agent, p may be a scalar or an array of probabilities
+        self.bernoulli_draws += len(self)
+        return self.rng.random(len(self)) < p
+
+    def draw_recovery_countdown(self, size, mean=14):
+        return np.floor(self.rng.normal(mean, 2, size)).astype(self.dtypes['recovery_countdown'])
+
+    def schedule_recovery(self, agents, countdown, first_tick):
+        # An Agent countdown first seen at first_tick reaches 1, and recovers, countdown - 1 ticks later
+        due = np.where(countdown > 0, first_tick + countdown.astype(np.int64) - 1, -1)
+        self.recovery_due[agents] = due
+        self.recoveries.schedule(agents, due)
+
+    def schedule_immunity_loss(self, agents, countdown, first_tick):
+        due = np.where(countdown > 0, first_tick + np.asarray(countdown, dtype=np.int64) - 1, -1)
+        self.immunity_due[agents] = due
+        self.immunity_losses.schedule(agents, due)
+
+    def schedule_death(self, agents, time):
+        # Agents that became infected at time roll for death every tick from day 7 of their infection,
+        # the first success of those rolls is a geometric draw
+        if self.model.mortality_rate <= 0:
+            self.death_due[agents] = -1
+            return
+        at_risk_from = np.maximum(time, self.infection_day[agents].astype(np.int64) + 7)
+        due = at_risk_from + self.rng.geometric(min(self.model.mortality_rate, 1.0), len(agents)) - 1
+        due = np.minimum(due, np.iinfo(self.dtypes['death_due']).max)
+        self.death_due[agents] = due
+        self.deaths.schedule(agents, due)
+
+    def due_now(self, calendar, due, time):
+        # Agents popped from calendar whose event is still due at time and who are alive
+        agents = calendar.pop(time)
+        agents = agents[(due[agents] == time) & (self.status[agents] != DEAD)]
+        return np.unique(agents)
+
+    def count(self, status):
+        return int(self.status_counts[status])
+
+    def set_status(self, agents, status):
+        # agents is a boolean mask or an index array
+        old_status = self.status[agents]
+        self.status_counts -= np.bincount(old_status, minlength=5)
+        self.status_counts[status] += len(old_status)
+        self.status[agents] = status
+
+    def move(self, alive, time):
+        if self.well_mixed:
+            # No positions, update_infected and check_for_health_worker scatter cell counts instead
+            return
+        move_probability, _ = self.policy.at(time)
+        stay_home = alive & (self.status != ISOLATED) & ~self.health_worker
+        movers = stay_home & self.bernoulli(move_probability)
+        # Health workers and isolated agents always move
+        movers |= alive & ~stay_home
+        no_movers = np.count_nonzero(movers)
+        if self.model.profiler is not None:
+            self.model.profiler.count('moved', no_movers)
+        self.x[movers] = self.rng.integers(0, self.width, no_movers, dtype=self.dtypes['x'])
+        self.y[movers] = self.rng.integers(0, self.height, no_movers, dtype=self.dtypes['y'])
+
+    def update_infected(self, alive, time):
+        susceptible = alive & (self.status == SUSCEPTIBLE)
+
+        # Each infected house member infects with probability 0.63
+        in_house = susceptible & (self.household >= 0)
+        k = np.zeros(len(self), dtype=np.int64)
+        k[in_house] = self.infected_housemates(in_house)
+        exposed_at_home = susceptible & (k > 0)
+        p_home = HouseholdTable.infection_probability(k)
+        infected_at_home = exposed_at_home & self.bernoulli(p_home)
+        self.infection_day[exposed_at_home] = time
+
+        contagious = (self.status == INFECTED) & contagious_on(time - self.infection_day)
+        exposed = susceptible & ~infected_at_home & self.contagious_near(contagious)
+        _, infection_rate = self.policy.at(time)
+        infected_outside = exposed & self.bernoulli(infection_rate)
+        self.infection_day[exposed] = time
+
+        # Once infected countdown to recovery begins
+        newly_infected = np.flatnonzero(infected_at_home | infected_outside)
+        self.set_status(newly_infected, INFECTED)
+        self.schedule_recovery(newly_infected, self.draw_recovery_countdown(len(newly_infected)), time)
+        self.schedule_death(newly_infected, time)
+
+    def update_recovered(self, time):
+        recovering = self.due_now(self.recoveries, self.recovery_due, time)
+        self.model.isolation_capacity += int(np.count_nonzero(self.status[recovering] == ISOLATED))
+        self.set_status(recovering, RECOVERED)
+        self.recovery_due[recovering] = -1
+        # After recovery countdown to immunity going away begins
+        self.schedule_immunity_loss(recovering, np.full(len(recovering), self.model.immunity_period), time)
+
+    def update_susceptible(self, time):
+        # After immunity wanes away, agent becomes susceptible
+        waning = self.due_now(self.immunity_losses, self.immunity_due, time)
+        self.set_status(waning, SUSCEPTIBLE)
+        self.immunity_due[waning] = -1
+
+    def random_activation(self, alive, time, first_tick):
+        # first_tick is the first tick whose recovery phase sees the new countdowns
+        activated = np.flatnonzero(alive & self.bernoulli(self.model.init_infected))
+        self.set_status(activated, INFECTED)
+        self.schedule_recovery(activated, self.draw_recovery_countdown(len(activated)), first_tick)
+        self.schedule_death(activated, time)
+
+    def check_for_health_worker(self, alive):
+        self.isolate(self.isolation_candidates(alive))
+
+    def isolation_candidates(self, alive):
+        # Infected health workers and infected agents with a health worker nearby
+        infected = alive & (self.status == INFECTED)
+        return np.flatnonzero(infected & (self.health_worker | self.health_worker_near()))
+
+    def isolate(self, candidates):
+        # Isolation beds go to a random subset of candidates while capacity lasts
+        capacity = max(self.model.isolation_capacity, 0)
+        if len(candidates) > capacity:
+            candidates = self.rng.choice(candidates, capacity, replace=False)
+        self.set_status(candidates, ISOLATED)
+        self.model.isolation_capacity -= len(candidates)
+
+    # Lookups across agents, TileShard answers them from data exchanged with the other tiles
+    # ---------------------------------------------------------------------
+    def infected_housemates(self, agents):
+        # Infected members of the household of each of agents, a boolean mask
+        return self.households.segment_sum(self.status == INFECTED)[self.household[agents]]
+
+    def contagious_near(self, contagious):
+        # Whether each agent has a contagious agent in a neighbouring cell
+        if self.well_mixed:
+            return self.bernoulli(self.contacts.mixed_exposure(np.count_nonzero(contagious), self.rng))
+        return self.contacts.exposure(self.x, self.y, contagious)[self.x, self.y] > 0
+
+    def health_worker_near(self):
+        # Whether each agent has a health worker in its own or a neighbouring cell
+        if self.well_mixed:
+            return self.bernoulli(self.contacts.mixed_health_worker_cover(np.count_nonzero(self.health_worker),
+                                                                           self.rng))
+        return self.contacts.health_worker_cover(self.x, self.y, self.health_worker)[self.x, self.y] > 0
+
+    def update_dead(self, time):
+        # death ration among infected people, an agent that left INFECTED since its death was drawn survives
+        due = self.due_now(self.deaths, self.death_due, time)
+        # Every popped death tick is spent, so migrating agents never file a past tick again
+        self.death_due[due] = -1
+        self.set_status(due[self.status[due] == INFECTED], DEAD)
+
+    def step(self, time):
+        alive = self.status != DEAD
+        phases = [
+            ('move', self.move, (alive, time)),
+            ('infection', self.update_infected, (alive, time)),
+            ('recovery', self.update_recovered, (time,)),
+            ('susceptible', self.update_susceptible, (time,)),
+            ('activation', self.random_activation, (alive, time, time + 1)),
+            ('isolation', self.check_for_health_worker, (alive,)),
+            ('death', self.update_dead, (time,)),
+        ]
+        profiler = self.model.profiler
+        no_alive = len(self) - self.count(DEAD)
+        for phase, method, args in phases:
+            if profiler is None:
+                method(*args)
+            else:
+                start = perf_counter()
+                method(*args)
+                profiler.add(phase, perf_counter() - start, no_alive)
+
+
+class ArrayGrid:
+    """Grid size of a numpy engine model, whose agent positions are VectorizedEngine columns"""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
@@ -0,0 +1,50 @@
+import numpy as np
+
+# Probability that an infected member passes the infection to each other member. As in the original
+# model this one rate drives all household transmission, whatever the size of the household.
+household_infection_probability = 0.63
+
+
+class HouseholdTable:
+    """Households as compressed arrays instead of per-household agent lists.
+
+    The members of household h are members[offsets[h]:offsets[h + 1]] (agent
+    indices) and household_of[i] is the household of agent i, -1 if the
+    population ran out before the agent got one.
+    """
+
+    def __init__(self, sizes, no_agents):
+        # Households are filled with agents in order until the agents run out
+        self.sizes = np.asarray(sizes, dtype=np.int16)
+        slots = np.concatenate([[0], np.cumsum(self.sizes, dtype=np.int64)])
+        self.offsets = np.minimum(slots, no_agents)
+        self.members = np.arange(self.offsets[-1], dtype=np.int32)
+        self.household_of = np.full(no_agents, -1, dtype=np.int32)
+        self.household_of[self.members] = np.repeat(np.arange(len(self.sizes), dtype=np.int32), np.diff(self.offsets))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def segment_sum(self, values):
+        # Sum of values over the members of every household
+        totals = np.concatenate([[0], np.cumsum(values[self.members])])
+        return totals[self.offsets[1:]] - totals[self.offsets[:-1]]
+
+    @staticmethod
+    def infection_probability(infected_members):
+        # Chance that at least one of k infected members infects a susceptible one
+        return 1.0 - (1.0 - household_infection_probability) ** infected_members
+
+
+# Share of households with 1 to 6 members
+household_size_distribution = [0.356, 0.339, 0.167, 0.092, 0.036, 0.011]
+
+
+def sample_household_sizes(no_agents, rng):
+    # One size per household in random order, about 0.65 households per agent
+    num_households = no_agents * 0.65
+    counts = [int(round(p * num_households)) for p in household_size_distribution]
+    # Adjust the number of households to match the total
+    counts[0] += int(round(num_households - sum(counts)))
+    sizes = np.repeat(np.arange(1, len(counts) + 1, dtype=np.int16), counts)
+    return rng.permutation(sizes)
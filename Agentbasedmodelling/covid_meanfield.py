@@ -0,0 +1,420 @@
+import argparse
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+from covid_batch import aggregate, compartments, default_params, expand_grid, parse_sweep, run_model
+from covid_engine import contagious_days
+from covid_households import household_infection_probability, household_size_distribution
+from covid_policy import PolicyTimeline
+from covid_spatial import moore_sum
+
+# First day of their infection on which agents can die, as in VectorizedEngine
+first_death_day = 7
+# From this day on an infection is neither contagious nor safe from death, so older ones are counted here
+max_day = 11
+# VectorizedEngine.draw_recovery_countdown draws new countdowns around 14 days whatever infection_period is
+recovery_mean = 14
+
+# Infected housemates a member of a random household has on average
+mean_housemates = (sum(size * (size - 1) * p for size, p in enumerate(household_size_distribution, 1))
+                   / sum(size * p for size, p in enumerate(household_size_distribution, 1)))
+
+
+def recovery_hazard(mean, size):
+    # Chance of recovering at each of size ticks into a countdown drawn as floor(N(mean, 2)), given that
+    # the agent got that far. A countdown of c recovers c - 1 ticks after its first tick, the last tick
+    # takes everyone left and countdowns below 1 (never recovering, about 1e-12) are left out.
+    edges = (np.arange(2, size + 2) - mean) / 2
+    cdf = np.array([0.0] + [0.5 * (1 + math.erf(e / math.sqrt(2))) for e in edges])
+    left = 1.0 - cdf[:-1]
+    hazard = np.divide(np.diff(cdf), left, out=np.ones(size), where=left > 1e-15)
+    hazard[-1] = 1.0
+    return hazard
+
+
+def binomial(rng, n, p):
+    # rng.binomial of every entry of n with p broadcast against it, skipping the many entries that draw 0
+    p = np.broadcast_to(p, n.shape)
+    out = np.zeros(n.shape, dtype=np.int64)
+    drawn = (n > 0) & (p > 0)
+    out[drawn] = rng.binomial(n[drawn], p[drawn])
+    return out
+
+
+def pick(rng, counts, number):
+    # About number[i] agents drawn at random from the compartments counts[i], for numbers far below the totals:
+    # draws hitting the same agent twice are dropped rather than drawn again
+    totals = counts.sum(axis=1, keepdims=True)
+    shares = np.where(totals > 0, counts / np.maximum(totals, 1), 1 / counts.shape[1])
+    return np.minimum(rng.multinomial(np.where(totals[:, 0] > 0, number, 0), shares), counts)
+
+
+class MeanFieldModel:
+    """Stochastic compartmental version of CovidModel, run for many replicates at once.
+
+    Infected agents are counted by ticks since their recovery countdown
+    started and days since infection, so contagiousness, death from day 7 and
+    the recovery countdown follow VectorizedEngine, and every transition is a
+    binomial draw made for all replicates together. Agents are taken to be
+    spread uniformly over the grid: contact_scale, one value or one per
+    replicate, stretches the neighbour contacts and household_scale the
+    housemates exposed by each infection to make up for the clustering of
+    the agent model (see calibrate). Like the agents, contacts infect with
+    the rate of the measures in effect at each step; lockdowns only change
+    how agents mix, which the calibrated contact_scale stands for, and the
+    restrictions timeline decides when the run ends. Options that only mean something to CovidModel
+    (engine, results_path, ...) are ignored.
+    """
+
+    def __init__(self, no_agents, width, height, init_infected, infection_period, immunity_period, mortality_rate,
+                 lockdown_status, protective_measures, perc_health_worker, household_size, isolation_capacity,
+                 replicates=1000, contact_scale=1.0, household_scale=1.0, seed=None,
+                 restrictions='Restrictions.csv', **model_options):
+        self.no_agents = no_agents
+        self.replicates = replicates
+        self.init_infected = init_infected
+        self.immunity_period = immunity_period
+        self.mortality_rate = mortality_rate
+        self.perc_health_worker = perc_health_worker
+        self.no_health_workers = int(round(no_agents * perc_health_worker))
+        self.contact_scale = np.broadcast_to(np.asarray(contact_scale, dtype=float), (replicates,))
+        self.household_scale = np.broadcast_to(np.asarray(household_scale, dtype=float), (replicates,))
+        self.rng = np.random.default_rng(seed)
+        self.policy = PolicyTimeline.load(restrictions).compile(lockdown_status, protective_measures)
+        self.running = True
+        self.steps = 0
+        self.history = []
+
+        # Share of grid cells with each number of neighbours, for the chance of a contact nearby
+        self.no_cells = width * height
+        neighbours, no_cells = np.unique(moore_sum(np.ones((width, height), dtype=np.int64)), return_counts=True)
+        self.neighbours = neighbours
+        self.cell_share = no_cells / self.no_cells
+
+        # One recovery hazard for countdowns around longest_countdown ticks: shorter ones start that many
+        # ticks further along it, so new countdowns (around 14) and initial ones (around infection_period)
+        # share it. Countdowns do not depend on who gets isolated or dies, so a hazard is all they need.
+        longest_countdown = max(recovery_mean, infection_period)
+        self.recovery_hazard = recovery_hazard(longest_countdown, longest_countdown + 16)
+        self.countdown_start = longest_countdown - recovery_mean
+
+        # Compartments of every replicate, infected by [ticks into the countdown, days since infection]
+        self.infected = np.zeros((replicates, len(self.recovery_hazard), max_day + 1), dtype=np.int64)
+        # Agents activated after the recovery phase, by day, whose countdown starts next tick
+        self.activated_late = np.zeros((replicates, max_day + 1), dtype=np.int64)
+        self.isolated = np.zeros((replicates, len(self.recovery_hazard)), dtype=np.int64)
+        # Recovered agents by ticks left until their immunity wanes, or in immune_for_good if it never does
+        self.immune = np.zeros((replicates, max(immunity_period, 1)), dtype=np.int64)
+        self.immune_for_good = np.zeros(replicates, dtype=np.int64)
+        self.dead = np.zeros(replicates, dtype=np.int64)
+        self.isolation_capacity = np.full(replicates, isolation_capacity, dtype=np.int64)
+
+        # Initial infections start on day 0 with countdowns around infection_period, like SyntheticPopulation
+        seeded = self.rng.binomial(no_agents, init_infected, replicates)
+        self.susceptible = no_agents - seeded
+        # Susceptible agents living with an infected one, infected at home from the next tick on
+        self.exposed_at_home = np.zeros(replicates, dtype=np.int64)
+        self.expose_housemates(seeded)
+        self.infected[:, longest_countdown - int(infection_period), 0] = seeded
+
+    def counts(self):
+        # Compartment counts of every replicate, in the order of compartments
+        return np.stack([self.susceptible + self.exposed_at_home, self.infected.sum(axis=(1, 2)),
+                         self.immune.sum(axis=1) + self.immune_for_good, self.isolated.sum(axis=1), self.dead], axis=1)
+
+    def exposure(self, number, scale, include_center=False):
+        # Chance that a random cell has one of number agents, dropped on random cells, in its neighbourhood
+        reach = np.minimum(np.multiply.outer(scale, self.neighbours + include_center) / self.no_cells, 1.0)
+        missed = (1.0 - reach) ** np.asarray(number, dtype=float)[:, None]
+        return 1.0 - missed @ self.cell_share
+
+    def step(self):
+        tick = self.steps
+        step = min(self.steps, self.policy.end_step)
+        if step >= self.policy.end_step:
+            self.running = False
+        _, self.infection_rate = self.policy.at(step)
+        alive = self.no_agents - self.dead
+        reseeding = self.infected.sum(axis=(1, 2)) / alive < self.init_infected * 100
+        self.activate(np.where(reseeding, self.init_infected, 0.0), tick, self.infected[:, self.countdown_start])
+        self.history.append(self.counts())
+
+        self.update_infected()
+        self.update_recovered()
+        self.update_susceptible()
+        self.activate(np.full(self.replicates, self.init_infected), tick, self.activated_late)
+        self.check_for_health_worker()
+        self.update_dead()
+        self.advance()
+
+    def run(self, max_steps=None):
+        # Step until the timeline ends, returns the counts as a (replicates, steps, compartments) array
+        while self.running and (max_steps is None or self.steps < max_steps):
+            self.step()
+        return np.stack(self.history, axis=1)
+
+    def update_infected(self):
+        # Exposed housemates catch it with probability 0.63, the others from contagious neighbours
+        contagious = self.infected[:, :, contagious_days[0]:contagious_days[1] + 1].sum(axis=(1, 2))
+        infected_at_home = self.rng.binomial(self.exposed_at_home, household_infection_probability)
+        self.exposed_at_home -= infected_at_home
+        p_outside = self.infection_rate * self.exposure(contagious, self.contact_scale)
+        infected_outside = self.rng.binomial(self.susceptible, p_outside)
+        self.susceptible -= infected_outside
+        self.expose_housemates(infected_outside)
+        self.infected[:, self.countdown_start, 0] += infected_at_home + infected_outside
+
+    def expose_housemates(self, number):
+        # The susceptible housemates of number agents infected from outside their household are exposed at home
+        expected = number * self.household_scale * mean_housemates * self.susceptible / self.no_agents
+        exposed = np.minimum(self.rng.poisson(expected), self.susceptible)
+        self.susceptible -= exposed
+        self.exposed_at_home += exposed
+
+    def update_recovered(self):
+        recovered = binomial(self.rng, self.infected, self.recovery_hazard[:, None])
+        self.infected -= recovered
+        recovered_isolated = binomial(self.rng, self.isolated, self.recovery_hazard)
+        self.isolated -= recovered_isolated
+        self.isolation_capacity += recovered_isolated.sum(axis=1)
+        recovering = recovered.sum(axis=(1, 2)) + recovered_isolated.sum(axis=1)
+        if self.immunity_period > 0:
+            self.immune[:, -1] += recovering
+        else:
+            self.immune_for_good += recovering
+
+    def update_susceptible(self):
+        self.susceptible += self.immune[:, 0]
+        self.immune[:, 0] = 0
+
+    def activate(self, p, tick, infected):
+        # Random activation of the alive agents with probability p per replicate, added by day to infected.
+        # Like the engine it keeps the agent's last infection day (0 for never exposed agents) and leaves
+        # isolation beds taken. Already infected agents drawn again only restart their countdown, which is left out.
+        from_susceptible = self.rng.binomial(self.susceptible, p)
+        self.susceptible -= from_susceptible
+        from_exposed = self.rng.binomial(self.exposed_at_home, p)
+        self.exposed_at_home -= from_exposed
+        from_immune = pick(self.rng, self.immune, self.rng.binomial(self.immune.sum(axis=1), p))
+        self.immune -= from_immune
+        from_for_good = self.rng.binomial(self.immune_for_good, p)
+        self.immune_for_good -= from_for_good
+        from_isolated = pick(self.rng, self.isolated, self.rng.binomial(self.isolated.sum(axis=1), p))
+        self.isolated -= from_isolated
+        # Recovered and isolated agents were infected more than max_day days ago
+        never_infected = from_susceptible + from_exposed
+        infected_before = from_immune.sum(axis=1) + from_for_good + from_isolated.sum(axis=1)
+        self.expose_housemates(never_infected + infected_before)
+        infected[:, min(tick, max_day)] += never_infected
+        infected[:, max_day] += infected_before
+
+    def check_for_health_worker(self):
+        # Infected health workers and infected agents with a health worker nearby get a bed while beds last.
+        # Every infected agent is isolated with the candidate chance scaled down to the expected free beds,
+        # so a tick can overshoot capacity by a few agents, who then wait for beds like in the engine.
+        cover = self.exposure(np.full(self.replicates, self.no_health_workers), np.ones(self.replicates), True)
+        p_candidate = self.perc_health_worker + (1 - self.perc_health_worker) * cover
+        expected = p_candidate * self.infected.sum(axis=(1, 2))
+        beds = np.maximum(self.isolation_capacity, 0)
+        p_isolated = p_candidate * np.minimum(beds / np.maximum(expected, 1e-12), 1.0)
+        isolated = binomial(self.rng, self.infected, p_isolated[:, None, None])
+        self.infected -= isolated
+        self.isolated += isolated.sum(axis=2)
+        self.isolation_capacity -= isolated.sum(axis=(1, 2))
+
+    def update_dead(self):
+        dying = binomial(self.rng, self.infected[:, :, first_death_day:], self.mortality_rate)
+        self.infected[:, :, first_death_day:] -= dying
+        self.dead += dying.sum(axis=(1, 2))
+
+    def advance(self):
+        # One tick later every countdown is one tick further along and every infection one day older,
+        # the last countdown tick always recovers so nothing is left to shift out
+        infected = np.zeros_like(self.infected)
+        infected[:, 1:, 1:] = self.infected[:, :-1, :-1]
+        infected[:, 1:, -1] += self.infected[:, :-1, -1]
+        infected[:, self.countdown_start, 1:] += self.activated_late[:, :-1]
+        infected[:, self.countdown_start, -1] += self.activated_late[:, -1]
+        self.infected = infected
+        self.activated_late[:] = 0
+        self.isolated[:, 1:] = self.isolated[:, :-1].copy()
+        self.isolated[:, 0] = 0
+        self.immune[:, :-1] = self.immune[:, 1:]
+        self.immune[:, -1] = 0
+        self.steps += 1
+
+
+def spawn_seeds(seed, number):
+    # Independent integer seeds drawn from seed, like the ones covid_batch.run_batch gives its runs
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(number)]
+
+
+def abm_runs(params, replicates, max_steps=None, seed=None):
+    # Compartment counts of replicates CovidModel runs, (replicates, steps, compartments), and the seconds taken
+    params = dict({'engine': 'numpy'}, **params)
+    start = time.perf_counter()
+    runs = [run_model(params, run_seed, max_steps) for run_seed in spawn_seeds(seed, replicates)]
+    seconds = time.perf_counter() - start
+    steps = min(len(run) for run in runs)
+    return np.stack([run[:steps] for run in runs]), seconds
+
+
+def calibrate(params, max_steps=100, abm_replicates=4, replicates=32, seed=None,
+              contact_scales=np.geomspace(0.25, 4, 13), household_scales=np.geomspace(0.25, 4, 9)):
+    """Contact and household scales that make MeanFieldModel follow short CovidModel runs.
+
+    Runs abm_replicates numpy engine runs of max_steps ticks, then every pair
+    of scales on the grid replicates times in a single MeanFieldModel, and
+    keeps the pair whose mean curves are closest to the agent-based ones. The
+    search is repeated once on a finer grid around that pair. Returns
+    (contact_scale, household_scale).
+    """
+    seeds = spawn_seeds(seed, 3)
+    abm, _ = abm_runs(params, abm_replicates, max_steps, seeds[0])
+    target = abm.mean(axis=0)
+    for round_seed in seeds[1:]:
+        pairs = np.array([(c, h) for c in contact_scales for h in household_scales])
+        model = MeanFieldModel(**dict(params, replicates=len(pairs) * replicates,
+                                      contact_scale=np.repeat(pairs[:, 0], replicates),
+                                      household_scale=np.repeat(pairs[:, 1], replicates), seed=round_seed))
+        curves = model.run(len(target)).reshape(len(pairs), replicates, len(target), len(compartments))
+        loss = ((curves.mean(axis=1) - target) ** 2).sum(axis=(1, 2))
+        contact_scale, household_scale = pairs[np.argmin(loss)]
+        # Finer grid around the best pair
+        contact_scales = contact_scale * np.geomspace(0.8, 1.25, 7)
+        household_scales = household_scale * np.geomspace(0.8, 1.25, 7)
+    return float(contact_scale), float(household_scale)
+
+
+class ComparisonReport:
+    """Mean curves of CovidModel and MeanFieldModel runs of the same parameters, and how far apart they are."""
+
+    def __init__(self, abm, mean_field, abm_seconds, mean_field_seconds, scales):
+        steps = min(abm.shape[1], mean_field.shape[1])
+        self.abm = abm[:, :steps]
+        self.mean_field = mean_field[:, :steps]
+        self.abm_seconds = abm_seconds
+        self.mean_field_seconds = mean_field_seconds
+        self.scales = scales
+
+    def curves(self):
+        # Mean and 5-95% band of both models per step, columns (model, statistic, compartment)
+        curves = {}
+        for name, runs in (('abm', self.abm), ('mean_field', self.mean_field)):
+            for statistic, values in (('mean', runs.mean(axis=0)), ('q0.05', np.quantile(runs, 0.05, axis=0)),
+                                      ('q0.95', np.quantile(runs, 0.95, axis=0))):
+                curves[name, statistic] = pd.DataFrame(values, columns=compartments)
+        return pd.concat(curves, axis=1).rename_axis('step')
+
+    def summary(self):
+        # One row per compartment, differences as a share of the population
+        no_agents = self.abm[0, 0].sum()
+        abm, mean_field = self.abm.mean(axis=0), self.mean_field.mean(axis=0)
+        low, high = np.quantile(self.mean_field, [0.05, 0.95], axis=0)
+        return pd.DataFrame({
+            'abm_peak': abm.max(axis=0),
+            'mean_field_peak': mean_field.max(axis=0),
+            'abm_peak_step': abm.argmax(axis=0),
+            'mean_field_peak_step': mean_field.argmax(axis=0),
+            'abm_final': abm[-1],
+            'mean_field_final': mean_field[-1],
+            'rmse_share': np.sqrt(((abm - mean_field) ** 2).mean(axis=0)) / no_agents,
+            'max_diff_share': np.abs(abm - mean_field).max(axis=0) / no_agents,
+            'abm_mean_in_band': ((abm >= low) & (abm <= high)).mean(axis=0),
+        }, index=compartments)
+
+    def __str__(self):
+        abm_per_run = self.abm_seconds / len(self.abm)
+        mean_field_per_run = self.mean_field_seconds / len(self.mean_field)
+        lines = [
+            f"{len(self.abm)} agent-based runs and {len(self.mean_field)} mean-field runs of {self.abm.shape[1]} steps, "
+            f"contact_scale={self.scales[0]:.3g} household_scale={self.scales[1]:.3g}",
+            f"seconds per run: agent-based {abm_per_run:.3g}, mean-field {mean_field_per_run:.3g} "
+            f"({abm_per_run / mean_field_per_run:.0f}x faster)",
+            self.summary().to_string(float_format=lambda v: f'{v:.3g}'),
+        ]
+        return '\n'.join(lines)
+
+
+def compare(params, max_steps=None, abm_replicates=10, replicates=1000, scales=None, seed=None):
+    # Run both models on params, calibrating first unless scales=(contact_scale, household_scale) is given
+    seeds = spawn_seeds(seed, 3)
+    if scales is None:
+        scales = calibrate(params, seed=seeds[0])
+    abm, abm_seconds = abm_runs(params, abm_replicates, max_steps, seeds[1])
+    start = time.perf_counter()
+    model = MeanFieldModel(**dict(params, replicates=replicates, contact_scale=scales[0],
+                                  household_scale=scales[1], seed=seeds[2]))
+    mean_field = model.run(max_steps)
+    return ComparisonReport(abm, mean_field, abm_seconds, time.perf_counter() - start, scales)
+
+
+def run_sweep(param_grid, replicates=1000, fixed_params=None, max_steps=None, seed=None,
+              calibrate_by=(), scales=None):
+    """Run every combination of param_grid replicates times with MeanFieldModel.
+
+    The result has the layout of covid_batch.run_batch, so aggregate works on
+    it too. The scales are calibrated once on the first combination, or
+    separately for every value of the parameters named in calibrate_by (those
+    that change how agents mix, such as lockdown_status), unless scales gives
+    them outright.
+    """
+    base_params = dict(default_params(), **(fixed_params or {}))
+    combinations = expand_grid(param_grid)
+    seeds = spawn_seeds(seed, len(combinations) + 1)
+    calibrations = {}
+    results = []
+    for run, (combination, combination_seed) in enumerate(zip(combinations, seeds)):
+        params = dict(base_params, **combination)
+        if scales is None:
+            key = tuple(params[name] for name in calibrate_by)
+            if key not in calibrations:
+                calibrations[key] = calibrate(params, seed=seeds[-1])
+            combination_scales = calibrations[key]
+        else:
+            combination_scales = scales
+        model = MeanFieldModel(**dict(params, replicates=replicates, contact_scale=combination_scales[0],
+                                      household_scale=combination_scales[1], seed=combination_seed))
+        counts = model.run(max_steps)
+        steps = counts.shape[1]
+        df = pd.DataFrame(counts.reshape(-1, len(compartments)), columns=compartments)
+        df.insert(0, 'step', np.tile(np.arange(steps), replicates))
+        for name, value in reversed(list(combination.items())):
+            df.insert(0, name, value)
+        df.insert(0, 'seed', combination_seed)
+        df.insert(0, 'replicate', np.repeat(np.arange(replicates), steps))
+        df.insert(0, 'run', run * replicates + df['replicate'])
+        results.append(df)
+    return pd.concat(results, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the mean-field version of CovidModel over a parameter grid')
+    parser.add_argument('--sweep', nargs='*', default=[], help="e.g. mortality_rate=0.01,0.02 immunity_period=30,60")
+    parser.add_argument('--replicates', type=int, default=1000)
+    parser.add_argument('--steps', type=int, default=None, help='stop runs early after this many steps')
+    parser.add_argument('--calibrate-by', nargs='*', default=[],
+                        help='calibrate separately for every value of these parameters, e.g. lockdown_status')
+    parser.add_argument('--scales', nargs=2, type=float, default=None, metavar=('CONTACT', 'HOUSEHOLD'),
+                        help='skip calibration and use these contact and household scales')
+    parser.add_argument('--compare', action='store_true',
+                        help='instead of a sweep, compare against agent-based runs of the default parameters')
+    parser.add_argument('--abm-replicates', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default='meanfield_results.csv')
+    parser.add_argument('--summary', default='meanfield_summary.csv')
+    args = parser.parse_args()
+
+    if args.compare:
+        report = compare(default_params(), args.steps, args.abm_replicates, args.replicates, args.scales, args.seed)
+        print(report)
+        report.curves().to_csv(args.summary)
+    else:
+        param_grid = parse_sweep(args.sweep)
+        results = run_sweep(param_grid, args.replicates, None, args.steps, args.seed, args.calibrate_by, args.scales)
+        results.to_csv(args.output, index=False)
+        aggregate(results, param_grid).to_csv(args.summary)
+        print(f"{results['run'].nunique()} runs written to {args.output}, summary in {args.summary}")
@@ -1,14 +1,24 @@
-import pandas as pd
 import numpy as np
 from mesa import Agent, Model
 from mesa.time import RandomActivation
 from mesa.datacollection import DataCollector
 from mesa.space import MultiGrid
 from mesa.visualization.UserParam import UserSettableParameter
-import scipy.stats as ss
 from enum import Enum
 import math
 import random
+import time
+import weakref
+from collections import Counter
+from covid_engine import VectorizedEngine, ArrayGrid, DEAD, contagious_on
+from covid_rng import ModelRandom
+from covid_spatial import ContactIndex, cell_offsets
+from covid_results import open_results_writer, open_output_pipeline
+from covid_policy import PolicyTimeline, movement_probability, infection_rates
+from covid_households import HouseholdTable
+from covid_checkpoint import write_checkpoint, read_checkpoint
+from covid_profiling import PhaseProfiler
+from covid_population import SyntheticPopulation
 
 # Simulation model parameters
 # -------------------------------------------------------------------------------------------
@@ -25,7 +35,8 @@ model_params = {
     'lockdown_status': 'Complete Lockdown',
     'protective_measures':'Both',
     'household_size': UserSettableParameter('slider', 'Household size', 2.1, 1, 6, 0.1),
-    'isolation_capacity' : 500 #assumption
+    'isolation_capacity' : 500, #assumption
+    'results_path': 'simulation_results.csv',
 
     # 'lockdown_status': UserSettableParameter('choice', 'Severity of Lockdown',
     #                                          value='No Lockdown',
@@ -44,6 +55,9 @@ class AgentStatus(Enum):
     recovered = 'Recovered'
     isolated = 'Isolated'
 
+# Status codes of the VectorizedEngine columns
+status_code = {status: code for code, status in enumerate(AgentStatus)}
+
 class LockdownStatus(Enum):
     no_lockdown = 'No Lockdown'
     partial = 'Partial Lockdown'
@@ -58,7 +72,8 @@ class ProtectiveMeasures(Enum):
 class Agent(Agent):
     """Agents in the CovidModel class below"""
 
-    def __init__(self, unique_id, model, lockdown_status, infection_rate, temperature,blood_oxygen_level):
+    def __init__(self, unique_id, model, temperature,blood_oxygen_level,
+                 status=AgentStatus.susceptible, health_worker=False, recovery_countdown=0):
         super().__init__(unique_id, model)
         self.model = model
         self.health_worker = False
@@ -67,31 +82,47 @@ class Agent(Agent):
         self.infection_day = 0
         self.temperature = temperature
         self.blood_oxygen_level = blood_oxygen_level
-        self.lockdown_status: LockdownStatus = lockdown_status
-        self.infection_rate = infection_rate
-        self.status = AgentStatus.infected if bool(ss.bernoulli.rvs(self.model.init_infected)) else AgentStatus.susceptible
-        self.health_worker = bool(ss.bernoulli.rvs(self.model.perc_health_worker))
-        self.recovery_countdown = 0
-        self.immunity_countdown = 0
+        # Initial infections, health workers and recovery countdowns come from the SyntheticPopulation,
+        # CovidModel.place_agents counts the initial statuses for the whole population at once
+        self._status = status
         self.household = None
-        self.household_transmission_probability = 0.1
-
-        # Random recovery countdown considers agents got infected at different times
-        if self.status == AgentStatus.infected:
-            self.recovery_countdown = math.floor(np.random.normal(self.model.infection_period, 2))
+        self.health_worker = health_worker
+        self.recovery_countdown = recovery_countdown
+        self.immunity_countdown = 0
+        # Whether the agent is counted as contagious in the model's ContactIndex
+        self.contagious = False
 
     def set_household(self, household):
         self.household = household
-        # Set the household transmission probability based on the size of the household
-        household_size = len(household.individuals)
-        if household_size == 1:
-            self.household_transmission_probability = 0.0
-        elif household_size == 2:
-            self.household_transmission_probability = 0.5
-        elif household_size == 3:
-            self.household_transmission_probability = 0.75
-        else:
-            self.household_transmission_probability = 0.9
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        old_status = self._status
+        if status is old_status:
+            return
+        self._status = status
+        self.model.status_changed(old_status, status)
+        if old_status is AgentStatus.infected:
+            self.model.contacts.discard(self)
+        # Keep the number of infected members of the household up to date
+        if self.household is not None:
+            if old_status is AgentStatus.infected:
+                self.model.household_infected[self.household.unique_id] -= 1
+            elif status is AgentStatus.infected:
+                self.model.household_infected[self.household.unique_id] += 1
+
+    def is_contagious(self, time):
+        return self.status == AgentStatus.infected and contagious_on(time - self.infection_day)
+
+    def relocate(self, pos):
+        self.model.contacts.move(self, self.pos, pos)
+        self.model.grid.move_agent(self, pos)
+        if self.model.profiler is not None:
+            self.model.profiler.count('moved')
 
     def update_infected(self):
         if self.status == AgentStatus.susceptible:
@@ -102,42 +133,37 @@ class Agent(Agent):
             # Checks if any of the agents in the cell are infected
             #any_infected = any(a.status == AgentStatus.infected for a in cell_agents)
 
-            for house_member in self.household.individuals:
-                if house_member.status == AgentStatus.infected:
-                    self.status = AgentStatus.infected if bool(ss.bernoulli.rvs(0.63)) else self.status
-                    self.infection_day = self.model.schedule.time
+            # Each infected house member infects with probability 0.63
+            infected_members = self.model.household_infected[self.household.unique_id]
+            if infected_members > 0:
+                p = self.model.household_table.infection_probability(infected_members)
+                self.status = AgentStatus.infected if self.model.rng.bernoulli(p) else self.status
+                self.infection_day = self.model.schedule.time
 
             # Check if any neighbors are infected and infect agent
-            neighbors = self.model.grid.get_neighbors(pos, moore=True)
-            infected_neighbors = any(
-                a.status == AgentStatus.infected and 1 < (self.model.schedule.time - a.infection_day) < 11 for a in
-                neighbors)
+            infected_neighbors = self.model.contacts.contagious_near(pos) > 0
 
             if infected_neighbors and self.status is not AgentStatus.infected:
                 if self.health_worker and self.blood_oxygen_level<90 and self.temperature>100:
-                    self.status = AgentStatus.infected if bool(ss.bernoulli.rvs(self.infection_rate)) else self.status
+                    self.status = AgentStatus.infected if self.model.rng.bernoulli(self.model.infection_rate) else self.status
                     self.infection_day = self.model.schedule.time
                 else:
-                    self.status = AgentStatus.infected if bool(ss.bernoulli.rvs(self.infection_rate)) else self.status
+                    self.status = AgentStatus.infected if self.model.rng.bernoulli(self.model.infection_rate) else self.status
                     self.infection_day = self.model.schedule.time
 
             # Once infected countdown to recovery begins
             if self.status == AgentStatus.infected:
-                self.recovery_countdown = math.floor(np.random.normal(14, 2))
+                self.recovery_countdown = math.floor(self.model.rng.normal(14, 2))
 
     def update_dead(self):
         # death ration among infected people
         if self.status == AgentStatus.infected and (self.model.schedule.time - self.infection_day) >= 7:
             ##remove from grid
-            self.status = AgentStatus.dead if bool(ss.bernoulli.rvs(self.model.mortality_rate)) else self.status
+            self.status = AgentStatus.dead if self.model.rng.bernoulli(self.model.mortality_rate) else self.status
 
     def check_for_health_worker(self):
         if self.health_worker == False and self.status == AgentStatus.infected :
-            neighbors = self.model.grid.get_cell_list_contents(self.pos)
-            neighbors.extend(self.model.grid.get_neighbors(self.pos, moore=True, include_center=True))
-            health_workers = [agent for agent in neighbors if agent.health_worker]
-             #print(health_workers)
-            if len(health_workers) > 0:
+            if self.model.contacts.health_workers_near(self.pos) > 0:
                 if self.model.isolation_capacity > 0:
                     #print("before isolation" + str(self.model.isolation_capacity))
                     self.status = AgentStatus.isolated
@@ -174,49 +200,51 @@ class Agent(Agent):
             self.immunity_countdown += -1
 
     def random_activation(self):
-        if bool(ss.bernoulli.rvs(self.model.init_infected)):
+        if self.model.rng.bernoulli(self.model.init_infected):
             self.status = AgentStatus.infected
-            self.recovery_countdown = math.floor(np.random.normal(14, 2))
+            self.recovery_countdown = math.floor(self.model.rng.normal(14, 2))
 
     def move(self):
         if self.status is not AgentStatus.dead and self.status is not AgentStatus.isolated and not self.health_worker:
             # possible_steps = self.model.grid.get_neighborhood(self.pos, moore=True, include_center=True)
             # new_position = self.random.choice(possible_steps)
-            if self.lockdown_status == LockdownStatus.no_lockdown.value:
-                if bool(ss.bernoulli.rvs(0.9)):
-                    x = self.random.randrange(self.model.grid.width)
-                    y = self.random.randrange(self.model.grid.height)
-                    self.model.grid.move_agent(self, (x, y))
-            elif self.lockdown_status == LockdownStatus.partial.value:
-                # print(f"Agent from pos {self.pos[0]} and {self.pos[1]} with state {self.status}")
-                if bool(ss.bernoulli.rvs(0.5)):
-                    x = self.random.randrange(self.model.grid.width)
-                    y = self.random.randrange(self.model.grid.height)
-                    # print(f"Agent from pos {self.pos[0]} and {self.pos[1]} with state {self.status}")
-                    self.model.grid.move_agent(self, (x, y))
-            elif self.lockdown_status == LockdownStatus.complete.value:
-                if bool(ss.bernoulli.rvs(0.1)):
-                    # print(f"Only I am moving")
-                    x = self.random.randrange(self.model.grid.width)
-                    y = self.random.randrange(self.model.grid.height)
-                    self.model.grid.move_agent(self, (x, y))
+            # The movement probability of the lockdown in effect this step
+            if self.model.rng.bernoulli(self.model.movement_probability):
+                x = self.random.randrange(self.model.grid.width)
+                y = self.random.randrange(self.model.grid.height)
+                self.relocate((x, y))
         #Healthworkers can move always
         else:
             x = self.random.randrange(self.model.grid.width)
             y = self.random.randrange(self.model.grid.height)
-            self.model.grid.move_agent(self, (x, y))
+            self.relocate((x, y))
 
     def step(self):
         if self.status is not AgentStatus.dead:
-            self.move()
+            if self.model.profiler is not None:
+                self.step_profiled(self.model.profiler)
+                return
+            # Otherwise everyone was already moved at once by CovidModel.relocate_agents
+            if self.model.movement == 'sequential':
+                self.move()
             self.update_infected()
             self.update_recovered()
             self.update_susceptible()
-            self.set_household(self.household)
             self.random_activation()
             self.check_for_health_worker()
             self.update_dead()
 
+    def step_profiled(self, profiler):
+        # Same as step, timing every phase
+        phases = (('move', self.move),) if self.model.movement == 'sequential' else ()
+        phases += (('infection', self.update_infected), ('recovery', self.update_recovered),
+                   ('susceptible', self.update_susceptible), ('activation', self.random_activation),
+                   ('isolation', self.check_for_health_worker), ('death', self.update_dead))
+        for phase, method in phases:
+            start = time.perf_counter()
+            method()
+            profiler.add(phase, time.perf_counter() - start)
+
 class Household:
     def __init__(self, unique_id, size):
         self.unique_id = unique_id
@@ -236,18 +264,46 @@ class CovidModel(Model):
                  immunity_period, mortality_rate,
                  lockdown_status, protective_measures,
                  perc_health_worker, household_size,
-                 isolation_capacity):
+                 isolation_capacity, engine='mesa', seed=None,
+                 results_path='simulation_results.csv', flush_every=50,
+                 restrictions='Restrictions.csv', checkpoint_every=None, checkpoint_path='checkpoint.npz',
+                 profile=False, movement='sequential', population=None, output_queue=None,
+                 sample_agents_every=None, agent_samples_path='agent_samples'):
+        # Constructor arguments, kept so a checkpoint can rebuild the model
+        self.params = dict(no_agents=no_agents, width=width, height=height, init_infected=init_infected,
+                           infection_period=infection_period, immunity_period=immunity_period,
+                           mortality_rate=mortality_rate, lockdown_status=lockdown_status,
+                           protective_measures=protective_measures, perc_health_worker=perc_health_worker,
+                           household_size=household_size, isolation_capacity=isolation_capacity,
+                           engine=engine, seed=seed, results_path=results_path, flush_every=flush_every,
+                           checkpoint_every=checkpoint_every, checkpoint_path=checkpoint_path, profile=profile,
+                           movement=movement, population=population if isinstance(population, str) else None,
+                           output_queue=output_queue, sample_agents_every=sample_agents_every,
+                           agent_samples_path=agent_samples_path)
+        # Per-phase timings and counters for every tick, see PhaseProfiler.summary
+        self.profiler = PhaseProfiler() if profile else None
+        # Snapshot the whole simulation every checkpoint_every steps, None disables it
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_path = checkpoint_path
+        # engine is 'mesa' for one Agent object per person or 'numpy' for the VectorizedEngine
+        self.engine = engine
+        # 'sequential' moves each agent in its own step, 'batch' moves all agents at the start of the
+        # tick and 'well_mixed' (numpy engine only) drops positions and scatters cell counts instead
+        if movement not in ('sequential', 'batch', 'well_mixed'):
+            raise ValueError(f"Unknown movement {movement!r}")
+        if movement == 'well_mixed' and engine != 'numpy':
+            raise ValueError("movement='well_mixed' needs engine='numpy'")
+        self.movement = movement
+        # One seed drives every random draw, so runs with the same seed are identical
+        self.seed = seed
+        self.rng = ModelRandom(seed)
+        self.random = random.Random(seed)
         self.no_agents = no_agents
-        self.grid = MultiGrid(width, height, False)
+        # The numpy engine keeps positions in its own arrays, so its grid only holds the size
+        self.grid = ArrayGrid(width, height) if engine == 'numpy' else MultiGrid(width, height, False)
         self.init_infected = init_infected
-        if protective_measures == ProtectiveMeasures.no_measure.value:
-            self.infection_rate = 0.07
-        elif protective_measures == ProtectiveMeasures.masks_mandatory.value:
-            self.infection_rate = 0.035
-        elif protective_measures == ProtectiveMeasures.social_distancing.value:
-            self.infection_rate = 0.05
-        elif protective_measures == ProtectiveMeasures.both.value:
-            self.infection_rate = 0.01
+        self.movement_probability = movement_probability[lockdown_status]
+        self.infection_rate = infection_rates[protective_measures]
         self.infection_period = infection_period
         self.immunity_period = immunity_period
         self.mortality_rate = mortality_rate
@@ -259,21 +315,8 @@ class CovidModel(Model):
         self.isolation_capacity = isolation_capacity
         self.schedule = RandomActivation(self)
         self.running = True
-
-        # Create agents
-        for i in range(self.no_agents):
-            temperature = random.uniform(97.0, 99.0)
-            blood_oxygen_level = random.randint(90, 100)
-            a = Agent(i, self, self.lockdown_status, self.infection_rate,temperature,blood_oxygen_level)
-            self.schedule.add(a)
-
-            # Add the agent to a random grid cell
-            x = self.random.randrange(self.grid.width)
-            y = self.random.randrange(self.grid.height)
-            self.grid.place_agent(a, (x, y))
-
-        # Set up households
-        self.setup_households()
+        # Running number of agents per status, kept by Agent.status
+        self.status_counts = {status: 0 for status in AgentStatus}
 
         # Collect count of susceptible, infected, and recovered agents
         self.datacollector = DataCollector({
@@ -289,142 +332,392 @@ class CovidModel(Model):
             '5_Member_House': 'household_size_distribution_5',
             '6_Member_House': 'household_size_distribution_6',
         })
+        # Rows are appended to results_path as they are collected, None disables saving
+        self.results = None
+        if results_path is not None:
+            self.results = open_results_writer(results_path, self.datacollector.model_vars, flush_every)
+        # Results rows, agent samples every sample_agents_every steps and console messages are written
+        # in order, on a background thread fed by a queue of at most output_queue items unless it is None
+        self.sample_agents_every = sample_agents_every
+        self.output = open_output_pipeline(self.results, agent_samples_path if sample_agents_every else None,
+                                           output_queue)
+        # Rows still buffered when a run is stopped early are written by close, on garbage collection or at exit
+        weakref.finalize(self, self.output.close)
+
+
+        # Per-cell counts of contagious agents and health workers
+        self.contacts = ContactIndex(self.grid.width, self.grid.height)
+
+        # population is a SyntheticPopulation, a path to cache one at or None to sample a new one
+        self.population = SyntheticPopulation.resolve(
+            population, seed, no_agents=no_agents, width=width, height=height, init_infected=init_infected,
+            perc_health_worker=perc_health_worker, infection_period=infection_period)
+        population = self.population
+
+        # restrictions is a csv path, a DataFrame in the same format or a PolicyTimeline
+        self.policy = PolicyTimeline.load(restrictions).compile(lockdown_status, protective_measures)
 
-        self.restrictions = pd.DataFrame(pd.read_csv(r'Restrictions.csv'))
-        self.restrictions['Date'] = pd.to_datetime(self.restrictions['Date'], format='%d-%m-%Y')
-        self.restrictions['NextDate'] = pd.to_datetime(self.restrictions['NextDate'], format='%d-%m-%Y')
-        self.restrictions['Steps'] = (self.restrictions['NextDate'] - self.restrictions['Date']).dt.days
-        self.restrictions['running_sum'] = self.restrictions['Steps'].cumsum()
-        self.restrictions['running_sum'] = self.restrictions.running_sum.shift(1)
-        self.restrictions['running_sum'] = self.restrictions['running_sum'].fillna(1)
+        # Create agents
+        if self.engine == 'numpy':
+            self.vector_engine = VectorizedEngine(self, self.policy, self.rng.generator)
+        else:
+            self.vector_engine = None
+            self.place_agents(population)
 
-    def setup_households(self):
-        # Create households and assign agents to them
-        self.households = []
-        # Set the distribution percentages
-        dist = [0.356, 0.339, 0.167, 0.092, 0.036, 0.011]
-        # Set the total number of households
-        num_households = self.no_agents * 0.65
-        # Calculate the number of households for each size category
-        sizes = [int(round(p * num_households)) for p in dist]
-        # Adjust the number of households to match the total
-        sizes[0] += int(round(num_households - sum(sizes)))
-        # Generate a list of household sizes
-        household_list = []
-        for i, size in enumerate(sizes):
-            household_list.extend([i + 1] * size)
-        # Shuffle the list to randomize the order
-        random.shuffle(household_list)
+        # Set up households, timed as part of construction for covid_benchmark
+        start = time.perf_counter()
+        self.setup_households(population.household_sizes.tolist())
+        self.setup_households_seconds = time.perf_counter() - start
 
+    def setup_households(self, household_list):
+        # Create households of the given sizes, from the population or a checkpoint, and assign agents to them
+        self.households = []
+        self.assign_households(list(household_list))
+
+    def place_agents(self, population):
+        # One Agent per row of the population, the grid cells are filled in one pass
+        statuses = list(AgentStatus)
+        columns = {name: getattr(population, name).tolist() for name in population.columns}
+        agents = []
+        for i in range(len(population)):
+            a = Agent(i, self, columns['temperature'][i],
+                      columns['blood_oxygen_level'][i], statuses[columns['status'][i]],
+                      columns['health_worker'][i], columns['recovery_countdown'][i])
+            a.pos = (columns['x'][i], columns['y'][i])
+            self.schedule.add(a)
+            agents.append(a)
+
+        order, offsets = cell_offsets(population.x, population.y, self.grid.width, self.grid.height)
+        by_cell = [agents[i] for i in order.tolist()]
+        bounds = offsets.tolist()
+        for cell in np.flatnonzero(np.diff(offsets)).tolist():
+            pos = divmod(cell, self.grid.height)
+            self.grid.grid[pos[0]][pos[1]][:] = by_cell[bounds[cell]:bounds[cell + 1]]
+            self.grid.empties.discard(pos)
+        counts = np.bincount(population.status, minlength=len(statuses))
+        self.status_counts = {status: int(counts[code]) for code, status in enumerate(statuses)}
+
+    def assign_households(self, household_list):
+        # Households never change, so their size distribution is counted once
+        self.household_size_counts = Counter(household_list)
+        sizes = [self.household_size_counts[size] for size in range(1, 7)]
+        self.output.log(f"sizes are {sizes} and total is {sum(sizes)}")
+        self.household_table = HouseholdTable(household_list, self.no_agents)
+
+        if self.vector_engine is not None:
+            # The engine only needs the table, no Household objects
+            self.vector_engine.set_households(self.household_table)
+            self.output.log(f"Total number of houses is {len(self.household_table)}")
+            self.output.log(f"Total placed agents are {len(self.household_table.members)}")
+            return
         for index, size in enumerate(household_list):
             self.households.append(Household(index, size))
-
-        print(f"sizes are {sizes} and total is {sum(sizes)}")
-        houses = 0
-        agent_num = 0
         agent_array = self.schedule.agents
+        offsets = self.household_table.offsets
         for house in self.households:
-            house.individuals = agent_array[:house.size]
-            for agent in agent_array[:house.size]:
+            house.individuals = agent_array[offsets[house.unique_id]:offsets[house.unique_id + 1]]
+            for agent in house.individuals:
                 agent.set_household(house)
-                agent_num += 1
-            agent_array = agent_array[house.size:]
-            houses += 1
-        print(f"Total number of houses is {houses}")
-        print(f"Total placed agents are {agent_num}")
+        infected = np.array([a.status is AgentStatus.infected for a in agent_array])
+        self.household_infected = self.household_table.segment_sum(infected).tolist()
+        self.output.log(f"Total number of houses is {len(self.households)}")
+        self.output.log(f"Total placed agents are {len(self.household_table.members)}")
+
+    def count(self, status):
+        if self.vector_engine is not None:
+            return self.vector_engine.count(status_code[status])
+        return self.status_counts[status]
+
+    def status_changed(self, old_status, new_status):
+        # Every Agent.status assignment comes through here to keep the running counts
+        if old_status is not None:
+            self.status_counts[old_status] -= 1
+        self.status_counts[new_status] += 1
 
     @property
     def susceptible(self):
-        agents = self.schedule.agents
-        susceptible = [a for a in agents if a.status == AgentStatus.susceptible]
-        return int(len(susceptible))
+        return self.count(AgentStatus.susceptible)
 
     @property
     def infected(self):
-        agents = self.schedule.agents
-        infected = [a for a in agents if a.status == AgentStatus.infected]
-        return int(len(infected))
+        return self.count(AgentStatus.infected)
 
     @property
     def immune(self):
-        agents = self.schedule.agents
-        immune = [a for a in agents if a.status == AgentStatus.recovered]
-        return int(len(immune))
+        return self.count(AgentStatus.recovered)
 
     @property
     def isolated(self):
-        agents = self.schedule.agents
-        isolated = [a for a in agents if a.status == AgentStatus.isolated]
-        return int(len(isolated))
+        return self.count(AgentStatus.isolated)
 
     @property
     def dead(self):
-        agents = self.schedule.agents
-        dead = [a for a in agents if a.status == AgentStatus.dead]
-        return int(len(dead))
+        return self.count(AgentStatus.dead)
 
     @property
     def household_size_distribution_1(self):
-        house_num = [household for household in self.households if household.size == 1]
-        return len(house_num)
+        return self.household_size_counts[1]
 
     @property
     def household_size_distribution_2(self):
-        house_num = [household for household in self.households if household.size == 2]
-        return len(house_num)
+        return self.household_size_counts[2]
 
     @property
     def household_size_distribution_3(self):
-        house_num = [household for household in self.households if household.size == 3]
-        return len(house_num)
+        return self.household_size_counts[3]
 
     @property
     def household_size_distribution_4(self):
-        house_num = [household for household in self.households if household.size == 4]
-        return len(house_num)
+        return self.household_size_counts[4]
 
     @property
     def household_size_distribution_5(self):
-        house_num = [household for household in self.households if household.size == 5]
-        return len(house_num)
+        return self.household_size_counts[5]
 
     @property
     def household_size_distribution_6(self):
-        house_num = [household for household in self.households if household.size == 6]
-        return len(house_num)
+        return self.household_size_counts[6]
 
     def step(self):
-        if self.schedule.steps >= max(self.restrictions['running_sum']):
+        if self.profiler is not None:
+            self.profiler.start_tick()
+            bernoulli_draws = self.bernoulli_draws
+        step = min(self.schedule.steps, self.policy.end_step)
+        if step >= self.policy.end_step:
             self.running = False
+        elif self.policy.change_at[step] >= 0:
+            row = self.policy.change_at[step]
+            self.output.log(f"{self.policy.lockdown_status[row]} {self.policy.protective_measures[row]}")
+            self.lockdown_status = self.policy.lockdown_status[row]
+            self.protective_measures = self.policy.protective_measures[row]
+        # Agents and the numpy engine move and infect with the rates in effect at this step
+        self.movement_probability, self.infection_rate = self.policy.at(step)
+        if self.vector_engine is not None:
+            self.step_vectorized()
         else:
-            result_df = self.restrictions[self.restrictions['running_sum'] == self.schedule.steps]
-            if result_df.empty == False:
-                print(result_df['lockdown_status'].values[0], result_df['protective_measures'].values[0])
-                self.lockdown_status = result_df['lockdown_status'].values[0]
-                self.protective_measures = result_df['protective_measures'].values[0]
-        if self.protective_measures == ProtectiveMeasures.no_measure.value:
-            self.infection_rate = 0.07
-        elif self.protective_measures == ProtectiveMeasures.masks_mandatory.value:
-            self.infection_rate = 0.035
-        elif self.protective_measures == ProtectiveMeasures.social_distancing.value:
-            self.infection_rate = 0.05
-        elif self.protective_measures == ProtectiveMeasures.both.value:
-            self.infection_rate = 0.01
-        #randomly infect if infection is too low
+            self.step_agents()
+        if self.profiler is not None:
+            self.profiler.count('bernoulli_draws', self.bernoulli_draws - bernoulli_draws)
+            # Backpressure of the output pipeline, items still queued after this tick
+            self.profiler.count('output_queue', self.output.depth())
+            self.profiler.end_tick()
+
+    def step_agents(self):
         active_agents = self.schedule.agents
-        alive_agents = [a for a in active_agents if a.status is not AgentStatus.dead]
-        infected = [a for a in active_agents if a.status == AgentStatus.infected]
-        if (int(len(infected))/int(len(alive_agents)) < self.init_infected *100):
-            for a in alive_agents:
+        no_alive = self.no_agents - self.dead
+        # Enough pre-drawn variates for the reseeding check and a typical tick
+        self.rng.reserve(5 * no_alive, no_alive)
+        #randomly infect if infection is too low
+        if self.infected / no_alive < self.init_infected * 100:
+            self.timed('reseeding', self.reseed, active_agents, agents=no_alive)
+
+        self.timed('collect', self.datacollector.collect, self)
+        if self.sample_agents_every and self.schedule.steps % self.sample_agents_every == 0:
+            self.timed('sample', self.sample_agents)
+        if self.movement == 'batch':
+            self.timed('relocation', self.relocate_agents, active_agents, agents=no_alive)
+        self.timed('contact_index', self.contacts.rebuild, active_agents, self.schedule.time, agents=self.no_agents)
+        self.schedule.step()
+        self.timed('save', self.save_results)
+        self.timed('checkpoint', self.save_checkpoint_if_due)
+
+    def step_vectorized(self):
+        engine = self.vector_engine
+        no_alive = self.no_agents - self.dead
+        if self.infected / no_alive < self.init_infected * 100:
+            self.timed('reseeding', engine.random_activation, engine.status != DEAD, self.schedule.time,
+                       self.schedule.time, agents=no_alive)
+
+        self.timed('collect', self.datacollector.collect, self)
+        if self.sample_agents_every and self.schedule.steps % self.sample_agents_every == 0:
+            self.timed('sample', self.sample_agents)
+        engine.step(self.schedule.time)
+        # The schedule holds no agents here but still keeps steps and time
+        self.schedule.step()
+        self.timed('save', self.save_results)
+        self.timed('checkpoint', self.save_checkpoint_if_due)
+
+    def relocate_agents(self, agents):
+        # Agent.move for all agents at once, then every grid cell is rebuilt in one pass
+        dead, isolated = AgentStatus.dead, AgentStatus.isolated
+        alive = np.array([a._status is not dead for a in agents], dtype=bool)
+        stay_home = alive & ~np.array([a._status is isolated or a.health_worker for a in agents], dtype=bool)
+        movers = alive & ~stay_home
+        movers |= stay_home & (self.rng.generator.random(len(agents)) < self.movement_probability)
+        self.rng.bernoulli_draws += int(np.count_nonzero(stay_home))
+
+        x = np.array([a.pos[0] for a in agents], dtype=np.int64)
+        y = np.array([a.pos[1] for a in agents], dtype=np.int64)
+        moved = np.flatnonzero(movers)
+        height = self.grid.height
+        left = x[moved] * height + y[moved]
+        x[moved] = self.rng.generator.integers(0, self.grid.width, len(moved))
+        y[moved] = self.rng.generator.integers(0, height, len(moved))
+        for i, pos in zip(moved.tolist(), zip(x[moved].tolist(), y[moved].tolist())):
+            agents[i].pos = pos
+
+        # Only the cells movers left or entered are refilled, in place so the garbage collector stays idle
+        order, offsets = cell_offsets(x, y, self.grid.width, height)
+        by_cell = [agents[i] for i in order.tolist()]
+        bounds = offsets.tolist()
+        for cell in np.unique(np.concatenate([left, x[moved] * height + y[moved]])).tolist():
+            pos = divmod(cell, height)
+            self.grid.grid[pos[0]][pos[1]][:] = by_cell[bounds[cell]:bounds[cell + 1]]
+            if bounds[cell] == bounds[cell + 1]:
+                self.grid.empties.add(pos)
+            else:
+                self.grid.empties.discard(pos)
+        if self.profiler is not None:
+            self.profiler.count('moved', len(moved))
+
+    def reseed(self, agents):
+        for a in agents:
+            if a.status is not AgentStatus.dead:
                 a.random_activation()
 
+    def timed(self, phase, function, *args, agents=1):
+        # Calls function, recording its wall time as phase when profiling is on
+        if self.profiler is None:
+            return function(*args)
+        start = time.perf_counter()
+        result = function(*args)
+        self.profiler.add(phase, time.perf_counter() - start, agents)
+        return result
 
-        self.datacollector.collect(self)
-        self.schedule.step()
-        self.save_results()
-        
+    @property
+    def bernoulli_draws(self):
+        if self.vector_engine is not None:
+            return self.rng.bernoulli_draws + self.vector_engine.bernoulli_draws
+        return self.rng.bernoulli_draws
 
     def save_results(self):
-        # Save results to CSV file
-        df = self.datacollector.get_model_vars_dataframe()
-        df.to_csv('simulation_results.csv', index=True)
+        # Append the row collected this step to the results file
+        if self.results is not None:
+            self.output.row([values[-1] for values in self.datacollector.model_vars.values()])
+        if not self.running:
+            self.output.close()
+
+    def close(self):
+        # Write out everything still buffered, also done when the timeline ends
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def sample_agents(self):
+        # Agent state at the time of the row just collected, in the same columns as a checkpoint
+        if self.vector_engine is not None:
+            arrays = self.vector_engine.get_state(self.schedule.time)
+        else:
+            arrays = self.agent_state()
+        self.output.agents(self.schedule.steps, arrays)
+
+    def save_checkpoint_if_due(self):
+        if self.checkpoint_every and self.schedule.steps % self.checkpoint_every == 0:
+            self.save_checkpoint(self.checkpoint_path)
+
+    def agent_state(self):
+        # Agent attributes of the Mesa path as arrays, the same columns as VectorizedEngine.get_state
+        agents = self.schedule.agents
+        return {
+            'status': np.array([status_code[a.status] for a in agents], dtype=np.uint8),
+            'health_worker': np.array([a.health_worker for a in agents], dtype=bool),
+            'recovery_countdown': np.array([a.recovery_countdown for a in agents], dtype=np.int64),
+            'immunity_countdown': np.array([a.immunity_countdown for a in agents], dtype=np.int64),
+            'infection_day': np.array([a.infection_day for a in agents], dtype=np.int64),
+            'temperature': np.array([a.temperature for a in agents]),
+            'blood_oxygen_level': np.array([a.blood_oxygen_level for a in agents], dtype=np.int64),
+            'x': np.array([a.pos[0] for a in agents], dtype=np.int64),
+            'y': np.array([a.pos[1] for a in agents], dtype=np.int64),
+        }
+
+    def set_agent_state(self, arrays):
+        statuses = list(AgentStatus)
+        columns = {name: values.tolist() for name, values in arrays.items()}
+        for i, a in enumerate(self.schedule.agents):
+            a._status = statuses[columns['status'][i]]
+            a.health_worker = columns['health_worker'][i]
+            a.recovery_countdown = columns['recovery_countdown'][i]
+            a.immunity_countdown = columns['immunity_countdown'][i]
+            a.infection_day = columns['infection_day'][i]
+            a.temperature = columns['temperature'][i]
+            a.blood_oxygen_level = columns['blood_oxygen_level'][i]
+            self.grid.move_agent(a, (columns['x'][i], columns['y'][i]))
+        counts = np.bincount(arrays['status'], minlength=len(statuses))
+        self.status_counts = {status: int(counts[code]) for code, status in enumerate(statuses)}
+
+    def save_checkpoint(self, path, compress=False):
+        # Snapshot of the full simulation state, restore it with CovidModel.load_checkpoint
+        if self.vector_engine is not None:
+            arrays = dict(self.vector_engine.get_state(self.schedule.time))
+        else:
+            arrays = self.agent_state()
+        rng_state = self.rng.get_state()
+        arrays['rng_uniforms'] = np.array(rng_state['uniforms'])
+        arrays['rng_normals'] = np.array(rng_state['normals'])
+        arrays['household_sizes'] = self.household_table.sizes
+        arrays['policy_start_steps'] = self.policy.start_steps
+        collected = list(self.datacollector.model_vars)
+        for i, name in enumerate(collected):
+            arrays[f'collected_{i}'] = np.array(self.datacollector.model_vars[name])
+        version, internal_state, gauss = self.random.getstate()
+        meta = {
+            'params': self.params,
+            'steps': self.schedule.steps,
+            'time': self.schedule.time,
+            'running': self.running,
+            'isolation_capacity': self.isolation_capacity,
+            'lockdown_status': self.lockdown_status,
+            'protective_measures': self.protective_measures,
+            'movement_probability': float(self.movement_probability),
+            'infection_rate': float(self.infection_rate),
+            'policy': {'lockdown_status': self.policy.lockdown_status,
+                       'protective_measures': self.policy.protective_measures,
+                       'end_step': self.policy.end_step},
+            'collected': collected,
+            'rng_generator': rng_state['generator'],
+            'random_state': [version, list(internal_state), gauss],
+        }
+        write_checkpoint(path, arrays, meta, compress)
+
+    @classmethod
+    def load_checkpoint(cls, path, **overrides):
+        # overrides replace constructor arguments, e.g. restrictions to branch a what-if policy
+        arrays, meta = read_checkpoint(path)
+        policy = meta['policy']
+        params = dict(meta['params'],
+                      restrictions=PolicyTimeline(arrays['policy_start_steps'], policy['lockdown_status'],
+                                                  policy['protective_measures'], policy['end_step']))
+        params.update(overrides)
+        model = cls(**params)
+        model.set_state(arrays, meta)
+        return model
+
+    def set_state(self, arrays, meta):
+        if self.vector_engine is not None:
+            self.vector_engine.set_state(arrays, meta['time'])
+        else:
+            self.set_agent_state(arrays)
+        self.setup_households(arrays['household_sizes'].tolist())
+        self.schedule.steps = meta['steps']
+        self.schedule.time = meta['time']
+        self.running = meta['running']
+        self.isolation_capacity = meta['isolation_capacity']
+        self.lockdown_status = meta['lockdown_status']
+        self.protective_measures = meta['protective_measures']
+        self.movement_probability = meta.get('movement_probability', movement_probability[self.lockdown_status])
+        self.infection_rate = meta['infection_rate']
+        self.rng.set_state({'generator': meta['rng_generator'],
+                            'uniforms': arrays['rng_uniforms'].tolist(),
+                            'normals': arrays['rng_normals'].tolist()})
+        version, internal_state, gauss = meta['random_state']
+        self.random.setstate((version, tuple(internal_state), gauss))
+        for i, name in enumerate(meta['collected']):
+            self.datacollector.model_vars[name] = arrays[f'collected_{i}'].tolist()
+        # The results file starts over with the rows collected before the checkpoint
+        if self.results is not None:
+            for row in zip(*self.datacollector.model_vars.values()):
+                self.output.row(row)
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+# Probability that a regular agent moves to a random cell each step, by LockdownStatus value
+movement_probability = {
+    'No Lockdown': 0.9,
+    'Partial Lockdown': 0.5,
+    'Complete Lockdown': 0.1,
+}
+
+# Infection rate of a contact with a contagious neighbour, by ProtectiveMeasures value
+infection_rates = {
+    'No Measures': 0.07,
+    'Mask Mandatory': 0.035,
+    'Social Distancing': 0.05,
+    'Both': 0.01,
+}
+
+
+class PolicyTimeline:
+    """Restriction schedule compiled into arrays indexed by model step.
+
+    Row i takes effect at start_steps[i] and the run ends at end_step. This
+    is the format of Restrictions.csv after the running sum of the row
+    durations, so any region or counterfactual written as such a table (or
+    passed as arrays) runs the same way. After compile() every lookup in
+    CovidModel.step is a plain array index, and the engines read the
+    movement probability and infection rate in effect at every step.
+    """
+
+    def __init__(self, start_steps, lockdown_status, protective_measures, end_step, comments=None):
+        self.start_steps = np.asarray(start_steps, dtype=np.int64)
+        self.lockdown_status = list(lockdown_status)
+        self.protective_measures = list(protective_measures)
+        self.end_step = int(end_step)
+        self.comments = list(comments) if comments is not None else [''] * len(self.lockdown_status)
+
+    @classmethod
+    def from_frame(cls, restrictions):
+        # Columns Date, NextDate, lockdown_status, protective_measures like Restrictions.csv
+        start = pd.to_datetime(restrictions['Date'], format='%d-%m-%Y')
+        end = pd.to_datetime(restrictions['NextDate'], format='%d-%m-%Y')
+        running_sum = (end - start).dt.days.cumsum().shift(1).fillna(1).astype(int).to_numpy()
+        comments = restrictions['Comment'] if 'Comment' in restrictions else None
+        # As before, the last row only marks the end of the run
+        return cls(running_sum, restrictions['lockdown_status'], restrictions['protective_measures'],
+                   running_sum.max(), comments)
+
+    @classmethod
+    def load(cls, restrictions):
+        # A PolicyTimeline, a DataFrame or the path of a csv in the Restrictions.csv format
+        if isinstance(restrictions, cls):
+            return restrictions
+        if isinstance(restrictions, pd.DataFrame):
+            return cls.from_frame(restrictions)
+        return cls.from_frame(pd.read_csv(restrictions))
+
+    def compile(self, lockdown_status, protective_measures):
+        # A copy with dense per-step arrays, starting from the model's initial lockdown and measures. The
+        # timeline itself is left as it is, so models sharing one never see each other's starting values.
+        compiled = type(self)(self.start_steps, self.lockdown_status, self.protective_measures, self.end_step,
+                              self.comments)
+        compiled.change_at = np.full(self.end_step + 1, -1, dtype=np.int64)
+        for row, step in enumerate(self.start_steps):
+            # Reaching end_step stops the run before any change is applied
+            if 0 <= step < self.end_step:
+                compiled.change_at[step] = row
+        lockdowns, measures = [], []
+        for row in compiled.change_at:
+            if row >= 0:
+                lockdown_status = self.lockdown_status[row]
+                protective_measures = self.protective_measures[row]
+            lockdowns.append(lockdown_status)
+            measures.append(protective_measures)
+        # Chance that a regular agent moves and infection rate of a contact, in effect at each step
+        compiled.movement_probability = np.array([movement_probability[lockdown] for lockdown in lockdowns])
+        compiled.infection_rate = np.array([infection_rates[measure] for measure in measures])
+        return compiled
+
+    def at(self, step):
+        # Movement probability and infection rate of a compiled timeline at step, the last ones after the end
+        step = min(step, self.end_step)
+        return self.movement_probability[step], self.infection_rate[step]
+
+    def __len__(self):
+        return self.end_step
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+
+from covid_checkpoint import read_checkpoint, write_checkpoint
+from covid_engine import INFECTED, SUSCEPTIBLE, column_dtypes, position_dtype
+from covid_households import sample_household_sizes
+
+# Constructor arguments a population is sampled from, a cached one must match them all
+population_params = ['no_agents', 'width', 'height', 'init_infected', 'perc_health_worker', 'infection_period']
+# Spawn key of the population's random stream, far from the keys SeedSequence.spawn hands out
+population_stream = 2 ** 31
+
+
+def population_rng(seed):
+    # The population gets its own stream of the model seed, so the model's stream is the same whether the
+    # population was sampled or loaded from a cache
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(population_stream,)))
+
+
+class SyntheticPopulation:
+    """Initial agents and households of a CovidModel, sampled as arrays.
+
+    Holds the starting status, health worker flag, recovery countdown,
+    temperature, blood oxygen level and grid position of every agent plus
+    the household sizes. Both engines are built from one, and save/load
+    keep it on disk so sweeps can reuse it instead of sampling again.
+    """
+
+    columns = ['status', 'health_worker', 'recovery_countdown', 'temperature', 'blood_oxygen_level', 'x', 'y']
+
+    def __init__(self, arrays, household_sizes, params):
+        for name in self.columns:
+            setattr(self, name, arrays[name])
+        self.household_sizes = household_sizes
+        self.params = params
+
+    def __len__(self):
+        return len(self.status)
+
+    @classmethod
+    def sample(cls, rng, no_agents, width, height, init_infected, perc_health_worker, infection_period):
+        pos_dtype = position_dtype(width, height)
+        status = np.where(rng.random(no_agents) < init_infected, INFECTED, SUSCEPTIBLE).astype(column_dtypes['status'])
+        infected = status == INFECTED
+        # Random recovery countdown considers agents got infected at different times
+        recovery_countdown = np.zeros(no_agents, dtype=column_dtypes['recovery_countdown'])
+        recovery_countdown[infected] = np.floor(rng.normal(infection_period, 2, np.count_nonzero(infected)))
+        arrays = {
+            'status': status,
+            'health_worker': rng.random(no_agents) < perc_health_worker,
+            'recovery_countdown': recovery_countdown,
+            'temperature': rng.uniform(97.0, 99.0, no_agents).astype(column_dtypes['temperature']),
+            'blood_oxygen_level': rng.integers(90, 101, no_agents, dtype=column_dtypes['blood_oxygen_level']),
+            'x': rng.integers(0, width, no_agents, dtype=pos_dtype),
+            'y': rng.integers(0, height, no_agents, dtype=pos_dtype),
+        }
+        params = dict(no_agents=no_agents, width=width, height=height, init_infected=init_infected,
+                      perc_health_worker=perc_health_worker, infection_period=infection_period)
+        return cls(arrays, sample_household_sizes(no_agents, rng), params)
+
+    def check(self, params):
+        # Raise if the population was sampled for different model parameters
+        different = [name for name in population_params if self.params[name] != params[name]]
+        if different:
+            raise ValueError(f"Population was sampled with different {', '.join(different)}")
+
+    def save(self, path):
+        arrays = {name: getattr(self, name) for name in self.columns}
+        arrays['household_sizes'] = self.household_sizes
+        write_checkpoint(path, arrays, {'population': self.params})
+
+    @classmethod
+    def load(cls, path):
+        arrays, meta = read_checkpoint(path)
+        return cls(arrays, arrays.pop('household_sizes'), meta['population'])
+
+    @classmethod
+    def resolve(cls, population, seed, **params):
+        # population is a SyntheticPopulation, a path to cache one at or None to sample one for seed
+        if population is None:
+            return cls.sample(population_rng(seed), **params)
+        if isinstance(population, str):
+            return cls.cached(population, population_rng(seed), **params)
+        population.check(params)
+        return population
+
+    @classmethod
+    def cached(cls, path, rng, **params):
+        # Load the population saved at path, or sample one and save it there for the next run
+        if os.path.exists(path):
+            population = cls.load(path)
+            population.check(params)
+            return population
+        population = cls.sample(rng, **params)
+        population.save(path)
+        return population
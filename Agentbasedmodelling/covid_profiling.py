@@ -0,0 +1,64 @@
+import time
+from collections import defaultdict
+
+import pandas as pd
+
+
+class PhaseProfiler:
+    """Opt-in per-tick instrumentation of CovidModel.
+
+    For every tick it records the wall time, number of calls and agents
+    touched of each phase, plus plain counters such as agents moved and
+    Bernoulli draws. The series are kept like DataCollector.model_vars, one
+    list entry per tick. A model built with profile=False has no profiler
+    and only pays for an `is None` check per agent step.
+    """
+
+    def __init__(self):
+        self.model_vars = defaultdict(list)
+        self.no_ticks = 0
+        self.current = None
+
+    def start_tick(self):
+        self.current = defaultdict(float)
+        self.tick_start = time.perf_counter()
+
+    def add(self, phase, seconds, agents=1):
+        self.current[phase + '_time'] += seconds
+        self.current[phase + '_calls'] += 1
+        self.current[phase + '_agents'] += agents
+
+    def count(self, counter, n=1):
+        self.current[counter] += n
+
+    def end_tick(self):
+        self.current['step_time'] = time.perf_counter() - self.tick_start
+        # Series that are missing this tick get a 0, new ones are back-filled with 0
+        for name in set(self.model_vars) | set(self.current):
+            if name not in self.model_vars:
+                self.model_vars[name] = [0] * self.no_ticks
+            self.model_vars[name].append(self.current.get(name, 0))
+        self.no_ticks += 1
+        self.current = None
+
+    def get_model_vars_dataframe(self):
+        return pd.DataFrame(dict(sorted(self.model_vars.items())))
+
+    def summary(self):
+        # Per-phase totals over all ticks, sorted by share of the step time
+        df = self.get_model_vars_dataframe()
+        if df.empty:
+            return 'No ticks profiled'
+        total = df['step_time'].sum()
+        phases = sorted((name[:-len('_time')] for name in df if name.endswith('_time') and name != 'step_time'),
+                        key=lambda phase: -df[phase + '_time'].sum())
+        lines = [f"{self.no_ticks} ticks, {total:.3f}s, {total / self.no_ticks * 1000:.2f}ms per tick",
+                 f"{'phase':<14}{'total s':>10}{'share':>8}{'ms/tick':>10}{'calls/tick':>12}{'agents/tick':>13}"]
+        for phase in phases:
+            seconds = df[phase + '_time'].sum()
+            lines.append(f"{phase:<14}{seconds:>10.3f}{seconds / total:>8.1%}"
+                         f"{seconds / self.no_ticks * 1000:>10.2f}{df[phase + '_calls'].mean():>12.1f}"
+                         f"{df[phase + '_agents'].mean():>13.0f}")
+        for counter in sorted(name for name in df if not name.rsplit('_', 1)[-1] in ('time', 'calls', 'agents')):
+            lines.append(f"{counter:<14}{df[counter].mean():>10.0f} per tick")
+        return '\n'.join(lines)
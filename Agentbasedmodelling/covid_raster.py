@@ -0,0 +1,75 @@
+import base64
+import time
+
+import numpy as np
+from mesa.visualization.ModularVisualization import VisualizationElement
+
+from covid_engine import DEAD
+from covid_model import AgentStatus, status_code
+
+# Raster codes: 0 is an empty cell, 1 + status code for each AgentStatus and one for health workers
+HEALTH_WORKER = len(status_code) + 1
+# Colour of every raster code: empty, one per AgentStatus, then health workers
+palette = ['white', 'lightblue', 'black', 'red', 'green', 'grey', 'yellow']
+
+
+def agent_codes(model):
+    # Cell index and raster code of every agent, dead health workers are drawn as dead
+    engine = model.vector_engine
+    if engine is not None:
+        cells = engine.x.astype(np.int64) * model.grid.height + engine.y
+        codes = engine.status.astype(np.int64) + 1
+        codes[engine.health_worker & (engine.status != DEAD)] = HEALTH_WORKER
+    else:
+        agents = model.schedule.agents
+        cells = np.array([a.pos[0] * model.grid.height + a.pos[1] for a in agents], dtype=np.int64)
+        codes = np.array([HEALTH_WORKER if a.health_worker and a.status is not AgentStatus.dead
+                          else status_code[a.status] + 1 for a in agents], dtype=np.int64)
+    return cells, codes
+
+
+def status_raster(model):
+    """Dominant raster code of every cell as a (height, width) uint8 image.
+
+    Rows run from the top of the grid down, like CanvasGrid draws them. A
+    cell takes the code most of its agents have, ties going to the lower code.
+    """
+    width, height = model.grid.width, model.grid.height
+    cells, codes = agent_codes(model)
+    counts = np.bincount(cells * len(palette) + codes, minlength=width * height * len(palette))
+    counts = counts.reshape(width * height, len(palette))
+    raster = counts.argmax(axis=1).astype(np.uint8)
+    return np.ascontiguousarray(raster.reshape(width, height).T[::-1])
+
+
+class RasterGrid(VisualizationElement):
+    """Grid view that ships one uint8 image per frame instead of a dict per agent.
+
+    The raster is sent base64-encoded inside Mesa's JSON message and drawn
+    with putImageData by RasterModule.js. Frames are rendered at most max_fps
+    times a second whatever the step rate; in between render returns None
+    and the browser keeps the last frame.
+    """
+
+    package_includes = []
+    local_includes = ['RasterModule.js']
+
+    def __init__(self, grid_width, grid_height, canvas_width=500, canvas_height=500, max_fps=10):
+        super().__init__()
+        self.grid_width = grid_width
+        self.grid_height = grid_height
+        self.min_interval = 1 / max_fps if max_fps else 0
+        self.last_frame = None
+        self.last_model = None
+        self.js_code = (f'elements.push(new RasterModule({grid_width}, {grid_height}, {canvas_width}, '
+                        f'{canvas_height}, {palette}));')
+
+    def render(self, model):
+        now = time.perf_counter()
+        # A reset builds a new model, its first frame is always drawn
+        if model is self.last_model and now - self.last_frame < self.min_interval:
+            return None
+        self.last_model = model
+        self.last_frame = now
+        raster = status_raster(model)
+        return {'step': model.schedule.steps, 'data': base64.b64encode(raster.tobytes()).decode('ascii')}
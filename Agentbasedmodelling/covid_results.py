@@ -0,0 +1,247 @@
+import abc
+import csv
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class ResultsWriter(abc.ABC):
+    """Appends one row of model variables per step to a results file.
+
+    Rows are buffered and written every flush_every steps and on close, so a
+    run costs O(T) in I/O instead of rewriting the whole file each step.
+    """
+
+    def __init__(self, path, columns, flush_every=50):
+        self.path = path
+        self.columns = list(columns)
+        self.flush_every = flush_every
+        self.rows = []
+        self.no_rows = 0
+        self.start()
+
+    def start(self):
+        pass
+
+    def append(self, row):
+        self.rows.append(row)
+        self.no_rows += 1
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.write(self.rows, self.no_rows - len(self.rows))
+            self.rows = []
+
+    @abc.abstractmethod
+    def write(self, rows, first_index):
+        # Write rows, the first of them being row first_index of the run
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class CsvResultsWriter(ResultsWriter):
+    """Same layout as DataFrame.to_csv(index=True) of the model vars"""
+
+    def start(self):
+        with open(self.path, 'w', newline='') as f:
+            csv.writer(f).writerow([''] + self.columns)
+
+    def write(self, rows, first_index):
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            for index, row in enumerate(rows, first_index):
+                writer.writerow([index] + list(row))
+
+
+class NpyResultsWriter(ResultsWriter):
+    """Writes each flush as a float64 chunk <path>/chunk_<first step>.npy"""
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        for chunk in glob.glob(os.path.join(self.path, 'chunk_*.npy')):
+            os.remove(chunk)
+        with open(os.path.join(self.path, 'columns.txt'), 'w') as f:
+            f.write('\n'.join(self.columns))
+
+    def write(self, rows, first_index):
+        np.save(os.path.join(self.path, f'chunk_{first_index:08d}.npy'), np.asarray(rows, dtype=np.float64))
+
+
+class ParquetResultsWriter(ResultsWriter):
+    """Writes each flush as a row group of one Parquet file, needs pyarrow"""
+
+    def start(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([('step', pa.int64())] + [(c, pa.float64()) for c in self.columns])
+        self.writer = pq.ParquetWriter(self.path, self.schema)
+
+    def write(self, rows, first_index):
+        values = np.asarray(rows, dtype=np.float64)
+        arrays = [self.pa.array(np.arange(first_index, first_index + len(rows)))]
+        arrays += [self.pa.array(values[:, i]) for i in range(len(self.columns))]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+results_writers = {
+    '.csv': CsvResultsWriter,
+    '.npy': NpyResultsWriter,
+    '.parquet': ParquetResultsWriter,
+}
+
+
+def open_results_writer(path, columns, flush_every=50):
+    # The file extension picks the format, a directory of .npy chunks for '.npy'
+    extension = os.path.splitext(path)[1]
+    if extension not in results_writers:
+        raise ValueError(f"Unknown results format {extension!r}, use one of {list(results_writers)}")
+    return results_writers[extension](path, columns, flush_every)
+
+
+class OutputPipeline:
+    """Results rows, per-agent samples and console messages of one CovidModel.
+
+    Everything the model outputs goes through submit, so it is written in
+    the order the model produced it. This base class writes on the calling
+    thread; AsyncOutputPipeline hands the work to a background thread.
+    results is a ResultsWriter or None, agent samples go to samples_path as
+    agents_<step>.npz.
+    """
+
+    def __init__(self, results=None, samples_path=None):
+        self.results = results
+        self.samples_path = samples_path
+        self.closed = False
+        if samples_path is not None:
+            os.makedirs(samples_path, exist_ok=True)
+
+    def row(self, row):
+        self.submit('row', tuple(row))
+
+    def agents(self, step, arrays):
+        # arrays are copied and frozen here, so the model can keep changing its own
+        snapshot = {}
+        for name, values in arrays.items():
+            snapshot[name] = np.array(values)
+            snapshot[name].setflags(write=False)
+        self.submit('agents', step, snapshot)
+
+    def log(self, message):
+        self.submit('log', message)
+
+    def submit(self, kind, *payload):
+        self.handle(kind, payload)
+
+    def handle(self, kind, payload):
+        if kind == 'row':
+            if self.results is not None:
+                self.results.append(list(payload[0]))
+        elif kind == 'agents':
+            step, arrays = payload
+            np.savez(os.path.join(self.samples_path, f'agents_{step:08d}.npz'), **arrays)
+        elif kind == 'log':
+            print(payload[0])
+
+    def depth(self):
+        # Items waiting to be written
+        return 0
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.results is not None:
+                self.results.close()
+
+
+class AsyncOutputPipeline(OutputPipeline):
+    """OutputPipeline that writes on a background thread fed by a bounded queue.
+
+    The simulation only waits when max_queued items are already pending.
+    How often and how long it waited is kept in blocked_puts and
+    blocked_seconds, and max_depth is the longest the queue got. An error in
+    the writer thread is raised again by the next submit or by close.
+    """
+
+    def __init__(self, results=None, samples_path=None, max_queued=1000):
+        super().__init__(results, samples_path)
+        self.queue = queue.Queue(max_queued)
+        self.blocked_puts = 0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='covid-output', daemon=True)
+        self.thread.start()
+
+    def submit(self, kind, *payload):
+        if self.error is not None:
+            raise self.error
+        # Once closed there is no writer thread, so anything more is written right away
+        if self.closed:
+            self.handle(kind, payload)
+            return
+        try:
+            self.queue.put_nowait((kind, payload))
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put((kind, payload))
+            self.blocked_puts += 1
+            self.blocked_seconds += time.perf_counter() - start
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # After a failure the rest of the queue is drained so the simulation never blocks on it
+            if self.error is None:
+                try:
+                    self.handle(*item)
+                except Exception as e:
+                    self.error = e
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def close(self):
+        if not self.closed:
+            self.queue.put(None)
+            self.thread.join()
+            super().close()
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+
+def open_output_pipeline(results=None, samples_path=None, max_queued=None):
+    # max_queued None writes on the simulation thread, otherwise on a background one
+    if max_queued is None:
+        return OutputPipeline(results, samples_path)
+    return AsyncOutputPipeline(results, samples_path, max_queued)
+
+
+def read_results(path):
+    # Load results written by any of the writers above into a DataFrame
+    extension = os.path.splitext(path)[1]
+    if extension == '.csv':
+        return pd.read_csv(path, index_col=0)
+    if extension == '.parquet':
+        return pd.read_parquet(path).set_index('step')
+    with open(os.path.join(path, 'columns.txt')) as f:
+        columns = f.read().split('\n')
+    chunks = [np.load(chunk) for chunk in sorted(glob.glob(os.path.join(path, 'chunk_*.npy')))]
+    return pd.DataFrame(np.concatenate(chunks) if chunks else np.empty((0, len(columns))), columns=columns)
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+class ModelRandom:
+    """Seeded random numbers for one CovidModel.
+
+    Uniform and standard normal variates are drawn from a numpy Generator in
+    blocks and handed out one at a time, which is much cheaper than a
+    scipy.stats call per draw. The same seed always gives the same sequence.
+    """
+
+    def __init__(self, seed=None, block_size=4096):
+        self.generator = np.random.default_rng(seed)
+        self.block_size = block_size
+        self._uniforms = []
+        self._next_uniform = 0
+        self._normals = []
+        self._next_normal = 0
+        self.bernoulli_draws = 0
+
+    def reserve(self, uniforms, normals=0):
+        # Pre-draw at least this many variates, e.g. at the start of a tick
+        if len(self._uniforms) - self._next_uniform < uniforms:
+            self._uniforms = self._uniforms[self._next_uniform:] + \
+                self.generator.random(max(uniforms, self.block_size)).tolist()
+            self._next_uniform = 0
+        if len(self._normals) - self._next_normal < normals:
+            self._normals = self._normals[self._next_normal:] + \
+                self.generator.standard_normal(max(normals, self.block_size)).tolist()
+            self._next_normal = 0
+
+    def random(self):
+        if self._next_uniform == len(self._uniforms):
+            self.reserve(self.block_size)
+        value = self._uniforms[self._next_uniform]
+        self._next_uniform += 1
+        return value
+
+    def bernoulli(self, p):
+        self.bernoulli_draws += 1
+        return self.random() < p
+
+    def uniform(self, low, high):
+        return low + (high - low) * self.random()
+
+    def randint(self, low, high):
+        # Inclusive of both ends, like random.randint
+        return low + int(self.random() * (high - low + 1))
+
+    def normal(self, mean, sd):
+        if self._next_normal == len(self._normals):
+            self.reserve(0, self.block_size)
+        value = self._normals[self._next_normal]
+        self._next_normal += 1
+        return mean + sd * value
+
+    def get_state(self):
+        # Generator state plus the variates drawn but not handed out yet
+        return {
+            'generator': self.generator.bit_generator.state,
+            'uniforms': self._uniforms[self._next_uniform:],
+            'normals': self._normals[self._next_normal:],
+        }
+
+    def set_state(self, state):
+        self.generator.bit_generator.state = state['generator']
+        self._uniforms = list(state['uniforms'])
+        self._next_uniform = 0
+        self._normals = list(state['normals'])
+        self._next_normal = 0
@@ -0,0 +1,324 @@
+import argparse
+import multiprocessing
+from collections import Counter
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from covid_batch import compartments, default_params
+from covid_engine import DEAD, INFECTED, ISOLATED, RECOVERED, SUSCEPTIBLE, VectorizedEngine, contagious_on
+from covid_households import HouseholdTable
+from covid_policy import PolicyTimeline
+from covid_population import SyntheticPopulation
+from covid_spatial import ContactIndex, moore_sum
+
+# Status code counted in each compartment, in the order of covid_batch.compartments
+compartment_codes = [SUSCEPTIBLE, INFECTED, RECOVERED, ISOLATED, DEAD]
+
+
+def tile_bounds(width, no_shards):
+    # Tile i owns grid columns bounds[i] <= x < bounds[i + 1]
+    if no_shards > width:
+        raise ValueError(f"Cannot split a grid {width} cells wide into {no_shards} tiles")
+    return np.linspace(0, width, no_shards + 1).round().astype(np.int64)
+
+
+def column_owners(bounds):
+    # Tile owning each grid column
+    return np.repeat(np.arange(len(bounds) - 1, dtype=np.int32), np.diff(bounds))
+
+
+class TileShard(VectorizedEngine):
+    """The agents standing on one vertical strip of the grid, run in a worker process.
+
+    It is a VectorizedEngine whose lookups across agents are answered from
+    data the ShardedCovidModel exchanges every tick: the contagious and
+    health worker counts of the columns just outside the strip (the halo),
+    the infected members of households spread over several tiles, and how
+    many isolation beds the tile gets. Agents that move off the strip are
+    handed to the tile they moved to.
+    """
+
+    # Per-agent columns that travel with a migrating agent
+    migrating_columns = VectorizedEngine.agent_columns + ['household', 'ids']
+
+    def __init__(self, params, policy, bounds, index, population, ids, household, no_households, seed):
+        self.index = index
+        self.bounds = bounds
+        self.x0, self.x1 = int(bounds[index]), int(bounds[index + 1])
+        self.owners = column_owners(bounds)
+        # Local counts have one halo column on each side, grid column x is local column x - x0 + 1
+        model = SimpleNamespace(grid=SimpleNamespace(width=params['width'], height=params['height']),
+                                contacts=ContactIndex(self.x1 - self.x0 + 2, params['height']),
+                                movement=params.get('movement', 'sequential'), population=population,
+                                init_infected=params['init_infected'], mortality_rate=params['mortality_rate'],
+                                immunity_period=params['immunity_period'], isolation_capacity=0, profiler=None)
+        super().__init__(model, policy, np.random.default_rng(seed))
+        # Agent ids of the single-process model, and global household index of every local agent
+        self.ids = ids
+        self.household = household
+        # Infected members of every household, filled in from the sparse counts each tick
+        self.household_infected = np.zeros(no_households, dtype=np.int64)
+
+    def local_x(self):
+        return self.x.astype(np.int64) - self.x0 + 1
+
+    def status_counts_list(self):
+        return self.status_counts.tolist()
+
+    # Steps of one tick, called by ShardedCovidModel in this order
+    # ---------------------------------------------------------------------
+    def start_tick(self, time, reseed):
+        # Random reseeding happens before the counts are collected, the agents then move
+        if reseed:
+            self.random_activation(self.status != DEAD, time, time)
+        counts = self.status_counts_list()
+        self.move(self.status != DEAD, time)
+        return counts, self.emigrate()
+
+    def emigrate(self):
+        # Columns of the agents now standing on other tiles, by destination tile
+        owner = self.owners[self.x]
+        leaving = owner != self.index
+        if not leaving.any():
+            return {}
+        # Leaving agents sorted by destination, each column is gathered once and split by tile
+        order = np.flatnonzero(leaving)
+        order = order[np.argsort(owner[order], kind='stable')]
+        tiles, starts = np.unique(owner[order], return_index=True)
+        columns = {name: np.split(getattr(self, name)[order], starts[1:]) for name in self.migrating_columns}
+        self.keep(~leaving)
+        return {tile: {name: columns[name][i] for name in self.migrating_columns}
+                for i, tile in enumerate(tiles.tolist())}
+
+    def keep(self, mask):
+        new_index = np.full(len(self), -1, dtype=np.int64)
+        new_index[mask] = np.arange(np.count_nonzero(mask))
+        self.status_counts -= np.bincount(self.status[~mask], minlength=5)
+        for name in self.migrating_columns:
+            setattr(self, name, getattr(self, name)[mask])
+        for calendar in (self.recoveries, self.immunity_losses, self.deaths):
+            calendar.remap(new_index)
+
+    def immigrate(self, packages, time):
+        # Take in migrating agents, then report what the other tiles need before the infection phase
+        if packages:
+            start = len(self)
+            for name in self.migrating_columns:
+                setattr(self, name, np.concatenate([getattr(self, name)] + [p[name] for p in packages]))
+            arrived = np.arange(start, len(self))
+            self.status_counts += np.bincount(self.status[arrived], minlength=5)
+            self.recoveries.schedule(arrived, self.recovery_due[arrived])
+            self.immunity_losses.schedule(arrived, self.immunity_due[arrived])
+            self.deaths.schedule(arrived, self.death_due[arrived])
+        return self.halo_edges(time), self.infected_households()
+
+    def halo_edges(self, time):
+        contagious = (self.status == INFECTED) & contagious_on(time - self.infection_day)
+        local_x = self.local_x()
+        self.contacts.contagious = self.contacts.count_cells(local_x, self.y, contagious)
+        self.contacts.health_workers = self.contacts.count_cells(local_x, self.y, self.health_worker)
+        # First and last owned column of both counts, they are the neighbours' halo columns
+        return {'left': (self.contacts.contagious[1], self.contacts.health_workers[1]),
+                'right': (self.contacts.contagious[-2], self.contacts.health_workers[-2])}
+
+    def infected_households(self):
+        # Households with infected agents on this tile and how many, as sorted sparse arrays
+        infected = (self.status == INFECTED) & (self.household >= 0)
+        return np.unique(self.household[infected], return_counts=True)
+
+    def infect(self, time, left, right, households):
+        # left and right are the halo columns, households the infected members of every household
+        self.set_halo(0, left)
+        self.set_halo(-1, right)
+        self.household_infected[:] = 0
+        self.household_infected[households[0]] = households[1]
+        alive = self.status != DEAD
+        self.update_infected(alive, time)
+        self.model.isolation_capacity = 0
+        self.update_recovered(time)
+        self.update_susceptible(time)
+        self.random_activation(alive, time, time + 1)
+        self.candidates = self.isolation_candidates(alive)
+        # Beds freed by recovered isolated agents and beds asked for
+        return self.model.isolation_capacity, len(self.candidates)
+
+    def set_halo(self, column, edges):
+        if edges is None:
+            self.contacts.contagious[column] = 0
+            self.contacts.health_workers[column] = 0
+        else:
+            self.contacts.contagious[column], self.contacts.health_workers[column] = edges
+
+    def finish_tick(self, time, beds):
+        # beds is this tile's share of the free isolation beds
+        candidates = self.candidates
+        if len(candidates) > beds:
+            candidates = self.rng.choice(candidates, beds, replace=False)
+        self.set_status(candidates, ISOLATED)
+        self.update_dead(time)
+        return self.status_counts_list()
+
+    # VectorizedEngine lookups answered from the exchanged data
+    # ---------------------------------------------------------------------
+    def infected_housemates(self, agents):
+        return self.household_infected[self.household[agents]]
+
+    def contagious_near(self, contagious):
+        return moore_sum(self.contacts.contagious)[self.local_x(), self.y] > 0
+
+    def health_worker_near(self):
+        return moore_sum(self.contacts.health_workers, include_center=True)[self.local_x(), self.y] > 0
+
+
+def serve_shard(conn, *shard_args):
+    # Worker process loop, runs the TileShard method named in every message until it gets None
+    shard = TileShard(*shard_args)
+    while True:
+        method, args = conn.recv()
+        if method is None:
+            break
+        conn.send(getattr(shard, method)(*args))
+    conn.close()
+
+
+class ShardedCovidModel:
+    """CovidModel with the numpy engine, split into vertical tiles run by worker processes.
+
+    Takes the same parameters as CovidModel, ignoring the ones about the
+    engine, results file, checkpoints and profiling. The population is sampled from
+    seed exactly as CovidModel samples it and dealt out to the tiles, and
+    every tick the tiles trade migrating agents, halo columns, household
+    infection counts and isolation beds through this process. The
+    compartment counts follow the same dynamics as a single-process run,
+    statistically rather than draw for draw since each tile draws from its
+    own random stream.
+    """
+
+    def __init__(self, no_shards, no_agents, width, height, init_infected, infection_period, immunity_period,
+                 mortality_rate, lockdown_status, protective_measures, perc_health_worker, household_size,
+                 isolation_capacity, seed=None, restrictions='Restrictions.csv', population=None,
+                 movement='sequential', **ignored):
+        if movement == 'well_mixed':
+            raise ValueError("movement='well_mixed' has no positions to split into tiles")
+        params = dict(no_agents=no_agents, width=width, height=height, init_infected=init_infected,
+                      infection_period=infection_period, immunity_period=immunity_period,
+                      mortality_rate=mortality_rate, lockdown_status=lockdown_status,
+                      protective_measures=protective_measures, movement=movement)
+        self.no_agents = no_agents
+        self.init_infected = init_infected
+        self.isolation_capacity = isolation_capacity
+        self.rng = np.random.default_rng(seed)
+        population = SyntheticPopulation.resolve(
+            population, seed, no_agents=no_agents, width=width, height=height, init_infected=init_infected,
+            perc_health_worker=perc_health_worker, infection_period=infection_period)
+        households = HouseholdTable(population.household_sizes, no_agents)
+        # Compiled once here, every tile looks up the same movement probability and infection rate
+        self.policy = PolicyTimeline.load(restrictions).compile(lockdown_status, protective_measures)
+        self.household_size_counts = Counter(population.household_sizes.tolist())
+
+        self.bounds = tile_bounds(width, no_shards)
+        owner = column_owners(self.bounds)[population.x]
+        seeds = np.random.SeedSequence(seed).spawn(no_shards)
+        context = multiprocessing.get_context('spawn')
+        self.connections = []
+        self.workers = []
+        for tile in range(no_shards):
+            ids = np.flatnonzero(owner == tile)
+            arrays = {name: getattr(population, name)[ids] for name in SyntheticPopulation.columns}
+            tile_population = SyntheticPopulation(arrays, None, population.params)
+            conn, worker_conn = context.Pipe()
+            worker = context.Process(target=serve_shard, daemon=True,
+                                     args=(worker_conn, params, self.policy, self.bounds, tile, tile_population,
+                                           ids, households.household_of[ids], len(households), seeds[tile]))
+            worker.start()
+            self.connections.append(conn)
+            self.workers.append(worker)
+
+        self.steps = 0
+        self.time = 0
+        self.running = True
+        self.counts = np.bincount(population.status, minlength=5)
+        self.model_vars = {name: [] for name in compartments}
+
+    def call(self, method, per_shard_args):
+        # Run method on every tile at once and gather the results in tile order
+        for conn, args in zip(self.connections, per_shard_args):
+            conn.send((method, args))
+        return [conn.recv() for conn in self.connections]
+
+    def step(self):
+        no_shards = len(self.connections)
+        if min(self.steps, self.policy.end_step) >= self.policy.end_step:
+            self.running = False
+        no_alive = self.no_agents - self.counts[DEAD]
+        reseed = self.counts[INFECTED] / no_alive < self.init_infected * 100
+
+        results = self.call('start_tick', [(self.time, reseed)] * no_shards)
+        self.counts = np.sum([counts for counts, _ in results], axis=0)
+        for name, code in zip(compartments, compartment_codes):
+            self.model_vars[name].append(int(self.counts[code]))
+        # Migrants are routed to the tile they moved to
+        arriving = [[packages[tile] for _, packages in results if tile in packages] for tile in range(no_shards)]
+        results = self.call('immigrate', [(packages, self.time) for packages in arriving])
+
+        # Infected household members summed over tiles, the same sparse arrays go to every tile
+        ids = np.concatenate([households[0] for _, households in results])
+        counts = np.concatenate([households[1] for _, households in results])
+        ids, where = np.unique(ids, return_inverse=True)
+        household_infected = (ids, np.bincount(where, weights=counts, minlength=len(ids)).astype(np.int64))
+        edges = [edge for edge, _ in results]
+        halos = [(edges[tile - 1]['right'] if tile > 0 else None,
+                  edges[tile + 1]['left'] if tile + 1 < no_shards else None,
+                  household_infected) for tile in range(no_shards)]
+        results = self.call('infect', [(self.time,) + halo for halo in halos])
+
+        # Free beds go to a uniformly random subset of the candidates of all tiles
+        self.isolation_capacity += sum(freed for freed, _ in results)
+        wanted = np.array([candidates for _, candidates in results], dtype=np.int64)
+        beds = max(self.isolation_capacity, 0)
+        given = wanted if wanted.sum() <= beds else self.rng.multivariate_hypergeometric(wanted, beds)
+        self.isolation_capacity -= int(given.sum())
+        results = self.call('finish_tick', [(self.time, int(n)) for n in given])
+        self.counts = np.sum(results, axis=0)
+        self.steps += 1
+        self.time += 1
+
+    def get_model_vars_dataframe(self):
+        df = pd.DataFrame(self.model_vars)
+        for size in range(1, 7):
+            df[f'{size}_Member_House'] = self.household_size_counts[size]
+        return df
+
+    def close(self):
+        for conn in self.connections:
+            conn.send((None, None))
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run CovidModel split into grid tiles over worker processes')
+    parser.add_argument('--agents', type=int, default=1000000)
+    parser.add_argument('--size', type=int, default=1000, help='width and height of the grid')
+    parser.add_argument('--shards', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--population', default=None, help='.npz file to load the population from or save it to')
+    parser.add_argument('--output', default='sharded_results.csv')
+    args = parser.parse_args()
+
+    params = dict(default_params(), no_agents=args.agents, width=args.size, height=args.size, seed=args.seed,
+                  population=args.population)
+    with ShardedCovidModel(args.shards, **params) as model:
+        while model.running and model.steps < args.steps:
+            model.step()
+        model.get_model_vars_dataframe().to_csv(args.output, index_label='Step')
+    print(f"{model.steps} steps of {args.agents} agents on {args.shards} tiles written to {args.output}")
@@ -0,0 +1,109 @@
+import numpy as np
+
+
+def moore_sum(counts, include_center=False):
+    # Sum of every cell's Moore neighbourhood on a non-toroidal grid
+    padded = np.pad(counts, 1)
+    width, height = counts.shape
+    total = np.zeros_like(counts)
+    for dx in (0, 1, 2):
+        for dy in (0, 1, 2):
+            total += padded[dx:dx + width, dy:dy + height]
+    if not include_center:
+        total -= counts
+    return total
+
+
+def cell_offsets(x, y, width, height):
+    # Counting sort of agents by cell, the agents in cell c are order[offsets[c]:offsets[c + 1]]
+    cells = x.astype(np.int64) * height + y
+    order = np.argsort(cells, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=width * height))])
+    return order, offsets
+
+
+class ContactIndex:
+    """Per-cell counts of contagious agents and health workers on the grid.
+
+    Replaces the neighbour scans in Agent.update_infected and
+    Agent.check_for_health_worker: whether an agent has a contagious
+    neighbour or a health worker nearby becomes a lookup in a 3x3 window
+    instead of a walk over the agents in the surrounding cells.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.contagious = np.zeros((width, height), dtype=np.int64)
+        self.health_workers = np.zeros((width, height), dtype=np.int64)
+
+    def count_cells(self, x, y, mask):
+        cells = x[mask].astype(np.int64) * self.height + y[mask]
+        counts = np.bincount(cells, minlength=self.width * self.height)
+        return counts.reshape(self.width, self.height)
+
+    # Array interface used by the VectorizedEngine, one convolution per tick
+    # ---------------------------------------------------------------------
+    def exposure(self, x, y, contagious):
+        self.contagious = self.count_cells(x, y, contagious)
+        return moore_sum(self.contagious)
+
+    def health_worker_cover(self, x, y, health_worker):
+        self.health_workers = self.count_cells(x, y, health_worker)
+        return moore_sum(self.health_workers, include_center=True)
+
+    # Grid-free interface for movement='well_mixed', cell counts without positions
+    # ---------------------------------------------------------------------
+    def scatter(self, number, rng):
+        # Cell counts of number agents dropped on uniformly random cells, multinomially distributed.
+        # Binning uniform cell draws is much cheaper than rng.multinomial over every cell.
+        no_cells = self.width * self.height
+        counts = np.bincount(rng.integers(0, no_cells, number), minlength=no_cells)
+        return counts.reshape(self.width, self.height)
+
+    def mixed_exposure(self, no_contagious, rng):
+        # Chance that an agent on a random cell has a contagious neighbour
+        self.contagious = self.scatter(no_contagious, rng)
+        return float(np.mean(moore_sum(self.contagious) > 0))
+
+    def mixed_health_worker_cover(self, no_health_workers, rng):
+        self.health_workers = self.scatter(no_health_workers, rng)
+        return float(np.mean(moore_sum(self.health_workers, include_center=True) > 0))
+
+    # Agent interface used by the Mesa path, kept up to date as agents move
+    # ---------------------------------------------------------------------
+    def rebuild(self, agents, time):
+        self.contagious[:] = 0
+        self.health_workers[:] = 0
+        for agent in agents:
+            x, y = agent.pos
+            agent.contagious = agent.is_contagious(time)
+            if agent.contagious:
+                self.contagious[x, y] += 1
+            if agent.health_worker:
+                self.health_workers[x, y] += 1
+
+    def move(self, agent, old_pos, new_pos):
+        if agent.contagious:
+            self.contagious[old_pos] -= 1
+            self.contagious[new_pos] += 1
+        if agent.health_worker:
+            self.health_workers[old_pos] -= 1
+            self.health_workers[new_pos] += 1
+
+    def discard(self, agent):
+        # Called when a contagious agent stops being infected
+        if agent.contagious:
+            self.contagious[agent.pos] -= 1
+            agent.contagious = False
+
+    def window(self, pos):
+        x, y = pos
+        return slice(max(x - 1, 0), x + 2), slice(max(y - 1, 0), y + 2)
+
+    def contagious_near(self, pos):
+        # Moore neighbourhood without the agent's own cell, like grid.get_neighbors
+        return int(self.contagious[self.window(pos)].sum() - self.contagious[pos])
+
+    def health_workers_near(self, pos):
+        return int(self.health_workers[self.window(pos)].sum())
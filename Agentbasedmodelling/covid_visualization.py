@@ -1,46 +1,13 @@
-from mesa.visualization.modules import CanvasGrid, ChartModule, BarChartModule
+from mesa.visualization.modules import ChartModule, BarChartModule
 from mesa.visualization.ModularVisualization import ModularServer
 from covid_model import *
 from covid_model import Household
 from covid_model import CovidModel, Household
+from covid_raster import RasterGrid
 
-def agent_portrayal(agent):
-    portrayal = {
-        'Shape': 'circle',
-        'Layer': 0,
-        'r': 1,
-        'Color': 'lightblue'}
-
-    if agent.status == AgentStatus.infected:
-        portrayal['Color'] = 'red'
-        portrayal['Filled'] = True
-        portrayal["Layer"] = 1
-        portrayal["scale"] = 0.9
-
-    if agent.status == AgentStatus.isolated:
-        portrayal['Color'] = 'grey'
-        portrayal['Filled'] = True
-        portrayal["Layer"] = 1
-        portrayal["scale"] = 0.9
-
-    if agent.status == AgentStatus.recovered:
-        portrayal['Color'] = 'green'
-        portrayal["Layer"] = 2
-        portrayal["scale"] = 0.9
-
-    if agent.health_worker == True:
-        portrayal['Color'] = 'yellow'
-        portrayal["Layer"] = 3
-        portrayal["scale"] = 0.9
-
-    if agent.status == AgentStatus.dead:
-        portrayal['Color'] = 'black'
-        portrayal["Layer"] = 0
-        portrayal["scale"] = 0.9
-
-    return portrayal
-
-grid = CanvasGrid(agent_portrayal, 141, 141, 1410, 1410)
+# A CanvasGrid sends a dict per agent every step, which stalls
+# the browser at 41,000 agents. RasterGrid sends one byte per cell, at most 10 frames a second.
+grid = RasterGrid(141, 141, 1410, 1410, max_fps=10)
 
 line_charts = ChartModule([
     {'Label': 'Susceptible', 'Color': 'lightblue'},
@@ -56,10 +23,13 @@ bar_chart = BarChartModule([{'Label': '1_Member_House', 'Color': 'red'},
                             {'Label': '5_Member_House', 'Color': 'grey'},
                             {'Label': '6_Member_House', 'Color': 'black'}])
 
+# The interactive server appends every row so the results file follows the browser
+server_params = dict(model_params, flush_every=1)
+
 server = ModularServer(CovidModel,
                        [grid, line_charts, bar_chart],
                        'COVID Simulation Model',
-                       model_params)
+                       server_params)
 
 server.port = 8521  # default port if unspecified
 server.launch()
@@ -0,0 +1,46 @@
+import contextlib
+import io
+
+import numpy as np
+
+from covid_calendar import CalendarQueue
+from covid_engine import DEAD
+from covid_model import CovidModel
+from test_covid_model import small_params
+
+
+def test_schedule_and_pop():
+    calendar = CalendarQueue()
+    calendar.schedule([0, 1, 2, 3], [5, 3, 5, -1])
+    assert len(calendar) == 3
+    assert sorted(calendar.pop(5).tolist()) == [0, 2]
+    assert calendar.pop(5).tolist() == []
+    assert calendar.pop(4).tolist() == []
+    assert calendar.pop(3).tolist() == [1]
+    assert len(calendar) == 0
+
+
+def test_remap_follows_renumbered_agents():
+    calendar = CalendarQueue()
+    calendar.schedule([0, 1, 2, 3], [2, 2, 4, 4])
+    # Agent 1 is gone, the others move down
+    calendar.remap(np.array([0, -1, 1, 2]))
+    assert calendar.pop(2).tolist() == [0]
+    assert sorted(calendar.pop(4).tolist()) == [1, 2]
+
+
+def test_engine_only_honours_entries_matching_the_current_due_tick():
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = CovidModel(**small_params(engine='numpy', seed=0)).vector_engine
+    calendar = CalendarQueue()
+    due = np.full(len(engine), -1)
+    due[[0, 1, 2, 3]] = 5
+    calendar.schedule([0, 1, 2, 3], due[[0, 1, 2, 3]])
+    # Agent 1 is rescheduled to tick 8, agent 2 cancelled and agent 3 dies, their tick 5 entries stay queued
+    due[1] = 8
+    calendar.schedule([1], [8])
+    due[2] = -1
+    engine.status[3] = DEAD
+    assert engine.due_now(calendar, due, 5).tolist() == [0]
+    assert engine.due_now(calendar, due, 8).tolist() == [1]
+    assert len(calendar) == 0
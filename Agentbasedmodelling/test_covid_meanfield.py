@@ -0,0 +1,29 @@
+import numpy as np
+
+from covid_batch import aggregate, compartments
+from covid_meanfield import MeanFieldModel, run_sweep
+from test_covid_model import small_params
+
+
+def test_every_replicate_keeps_every_agent():
+    params = small_params(mortality_rate=0.05, immunity_period=10)
+    counts = MeanFieldModel(**dict(params, replicates=200, seed=1)).run(80)
+    assert counts.shape == (200, 80, len(compartments))
+    assert (counts >= 0).all()
+    assert (counts.sum(axis=2) == params['no_agents']).all()
+
+
+def test_same_seed_gives_the_same_counts():
+    params = small_params()
+    first = MeanFieldModel(**dict(params, replicates=20, seed=4)).run(30)
+    assert np.array_equal(first, MeanFieldModel(**dict(params, replicates=20, seed=4)).run(30))
+
+
+def test_sweep_results_aggregate_like_batch_results():
+    results = run_sweep({'mortality_rate': [0.01, 0.05]}, replicates=10, fixed_params=small_params(),
+                        max_steps=25, seed=0, scales=(1.0, 1.0))
+    assert len(results) == 2 * 10 * 25
+    summary = aggregate(results, ['mortality_rate'])
+    assert summary.index.names == ['mortality_rate', 'step']
+    assert len(summary) == 2 * 25
+    assert np.allclose(summary['mean'].sum(axis=1), small_params()['no_agents'])
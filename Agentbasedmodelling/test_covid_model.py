@@ -0,0 +1,142 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+from covid_batch import compartments, default_params, run_model
+from covid_model import CovidModel
+from covid_policy import PolicyTimeline
+from covid_shards import ShardedCovidModel
+
+restrictions = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Restrictions.csv')
+
+
+def small_params(**overrides):
+    # A small grid with enough initial infections that a few dozen steps see the whole epidemic
+    params = dict(default_params(), no_agents=1500, width=30, height=30, init_infected=0.005,
+                  protective_measures='No Measures', results_path=None, restrictions=restrictions)
+    params.update(overrides)
+    return params
+
+
+def steady_timeline(end_step=1000):
+    # No restriction changes, the run keeps the starting lockdown and measures throughout
+    return PolicyTimeline([], [], [], end_step)
+
+
+def run_frame(steps, **params):
+    with contextlib.redirect_stdout(io.StringIO()), CovidModel(**small_params(**params)) as model:
+        for _ in range(steps):
+            model.step()
+    return model.datacollector.get_model_vars_dataframe()
+
+
+@pytest.mark.parametrize('engine', ['mesa', 'numpy'])
+def test_same_seed_gives_the_same_frame(engine):
+    first = run_frame(20, engine=engine, seed=3)
+    assert first.equals(run_frame(20, engine=engine, seed=3))
+    assert not first.equals(run_frame(20, engine=engine, seed=4))
+
+
+@pytest.mark.parametrize('engine', ['mesa', 'numpy'])
+def test_a_cached_population_gives_the_same_frame(engine, tmp_path):
+    # The first run with population=path samples and saves it, the second loads it
+    path = str(tmp_path / 'population.npz')
+    sampled = run_frame(20, engine=engine, seed=7)
+    assert sampled.equals(run_frame(20, engine=engine, seed=7, population=path))
+    assert os.path.exists(path)
+    assert sampled.equals(run_frame(20, engine=engine, seed=7, population=path))
+
+
+def test_construction_logs_the_household_sizes(capsys):
+    with CovidModel(**small_params(engine='numpy', seed=7)) as model:
+        sizes = [model.household_size_counts[size] for size in range(1, 7)]
+    assert f"sizes are {sizes} and total is {sum(sizes)}" in capsys.readouterr().out
+
+
+def test_mesa_and_numpy_mean_curves_agree():
+    # Mean compartment curves over seeded replicates, within 5 standard errors plus 1% of the agents
+    params = small_params(restrictions=steady_timeline())
+    mesa = np.array([run_model(dict(params, engine='mesa'), seed, 40) for seed in range(10)])
+    numpy = np.array([run_model(dict(params, engine='numpy'), seed, 40) for seed in range(10)])
+    standard_error = np.sqrt(mesa.var(axis=0, ddof=1) / len(mesa) + numpy.var(axis=0, ddof=1) / len(numpy))
+    difference = np.abs(mesa.mean(axis=0) - numpy.mean(axis=0))
+    assert mesa.shape == numpy.shape == (10, 40, len(compartments))
+    assert (difference <= 5 * standard_error + 0.01 * params['no_agents']).all()
+
+
+@pytest.mark.parametrize('engine', ['mesa', 'numpy'])
+def test_resuming_a_checkpoint_matches_an_uninterrupted_run(engine, tmp_path):
+    path = str(tmp_path / 'checkpoint.npz')
+    with contextlib.redirect_stdout(io.StringIO()):
+        with CovidModel(**small_params(engine=engine, seed=5)) as model:
+            for _ in range(15):
+                model.step()
+            model.save_checkpoint(path)
+        with CovidModel.load_checkpoint(path) as resumed:
+            for _ in range(15):
+                resumed.step()
+    assert resumed.datacollector.get_model_vars_dataframe().equals(run_frame(30, engine=engine, seed=5))
+
+
+def test_two_strip_sharded_model_keeps_every_agent():
+    params = small_params(seed=2)
+    with contextlib.redirect_stdout(io.StringIO()), ShardedCovidModel(2, **params) as model:
+        for _ in range(20):
+            model.step()
+            assert model.counts.sum() == params['no_agents']
+    frame = model.get_model_vars_dataframe()
+    assert len(frame) == 20
+    assert (frame[compartments].sum(axis=1) == params['no_agents']).all()
+
+
+def test_models_sharing_a_timeline_keep_their_own_starting_rates():
+    timeline = PolicyTimeline([5], ['Complete Lockdown'], ['Both'], 10)
+    with contextlib.redirect_stdout(io.StringIO()):
+        first = CovidModel(**small_params(restrictions=timeline, engine='numpy', lockdown_status='No Lockdown'))
+        second = CovidModel(**small_params(restrictions=timeline, engine='numpy', lockdown_status='Partial Lockdown',
+                                           protective_measures='Mask Mandatory'))
+    assert first.policy.at(0) == (0.9, 0.07)
+    assert second.policy.at(0) == (0.5, 0.035)
+    assert first.policy.at(5) == second.policy.at(5) == (0.1, 0.01)
+    assert first.policy.at(50) == (0.1, 0.01)
+    assert not hasattr(timeline, 'infection_rate')
+
+
+@pytest.mark.parametrize('engine', ['mesa', 'numpy'])
+def test_restriction_changes_drive_the_run(engine):
+    # Switching to a lockdown at step 0 runs exactly like starting in it
+    switched = PolicyTimeline([0], ['Complete Lockdown'], ['Both'], 1000)
+    frame = run_frame(20, engine=engine, seed=1, restrictions=switched)
+    assert frame.equals(run_frame(20, engine=engine, seed=1, restrictions=steady_timeline(),
+                                  lockdown_status='Complete Lockdown', protective_measures='Both'))
+    assert not frame.equals(run_frame(20, engine=engine, seed=1, restrictions=steady_timeline()))
+
+
+def test_two_strip_sharded_model_matches_a_single_process_run():
+    # Mean compartment curves over seeded replicates, with the tolerance of the engine agreement test
+    params = small_params(restrictions=steady_timeline())
+    sharded = []
+    for seed in range(10):
+        with contextlib.redirect_stdout(io.StringIO()), ShardedCovidModel(2, **dict(params, seed=seed)) as model:
+            for _ in range(40):
+                model.step()
+        sharded.append(model.get_model_vars_dataframe()[compartments].to_numpy())
+    sharded = np.array(sharded)
+    single = np.array([run_model(dict(params, engine='numpy'), seed, 40) for seed in range(10)])
+    standard_error = np.sqrt(sharded.var(axis=0, ddof=1) / len(sharded) + single.var(axis=0, ddof=1) / len(single))
+    difference = np.abs(sharded.mean(axis=0) - single.mean(axis=0))
+    assert sharded.shape == single.shape
+    assert (difference <= 5 * standard_error + 0.01 * params['no_agents']).all()
+
+
+def test_numpy_engine_keeps_no_past_death_ticks():
+    # A death tick is cleared once due, also for agents that recovered before it
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = CovidModel(**small_params(engine='numpy', seed=6, mortality_rate=0.05))
+        for _ in range(40):
+            model.step()
+    death_due = model.vector_engine.death_due
+    assert not ((death_due >= 0) & (death_due < model.schedule.time)).any()
@@ -0,0 +1,71 @@
+import contextlib
+import gc
+import io
+
+import pandas as pd
+import pytest
+
+from covid_model import CovidModel
+from covid_results import ResultsWriter, open_results_writer, read_results
+from test_covid_model import small_params
+
+columns = ['Susceptible', 'Infected', 'Dead']
+rows = [[100 - i, i, i // 3] for i in range(7)]
+
+
+def write_rows(path, flush_every=3):
+    writer = open_results_writer(path, columns, flush_every)
+    for row in rows:
+        writer.append(row)
+    writer.close()
+    return read_results(path)
+
+
+@pytest.mark.parametrize('name', ['results.csv', 'results.npy', 'results.parquet'])
+def test_results_round_trip(tmp_path, name):
+    if name.endswith('.parquet'):
+        pytest.importorskip('pyarrow')
+    frame = write_rows(str(tmp_path / name))
+    assert list(frame.columns) == columns
+    assert frame.to_numpy().tolist() == rows
+    assert frame.index.tolist() == list(range(len(rows)))
+
+
+def test_rewriting_a_results_file_starts_over(tmp_path):
+    path = str(tmp_path / 'results.npy')
+    write_rows(path)
+    assert len(write_rows(path, flush_every=50)) == len(rows)
+
+
+def test_unknown_results_format_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        open_results_writer(str(tmp_path / 'results.xlsx'), columns)
+
+
+def test_results_writers_must_write():
+    with pytest.raises(TypeError):
+        ResultsWriter('results', columns)
+
+
+def run_stopped_early(path, stop):
+    # Seven steps, well before flush_every and the end of the timeline, then the run is dropped
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = CovidModel(**small_params(engine='numpy', seed=2, results_path=path, flush_every=50))
+        for _ in range(7):
+            model.step()
+    expected = model.datacollector.get_model_vars_dataframe()
+    if stop == 'close':
+        model.close()
+    else:
+        del model
+        gc.collect()
+    return expected
+
+
+@pytest.mark.parametrize('stop', ['close', 'collect'])
+def test_a_run_stopped_early_keeps_its_rows(tmp_path, stop):
+    path = str(tmp_path / 'results.csv')
+    expected = run_stopped_early(path, stop)
+    frame = read_results(path)
+    assert len(frame) == 7
+    pd.testing.assert_frame_equal(frame, expected, check_dtype=False)